@@ -0,0 +1,80 @@
+import threading
+from typing import Union
+
+class AttemptTracker:
+    '''### In-memory sliding window of the attempts
+    For every (module, ip) the distinct service ids seen in the window with their last timestamp.
+    The jail decision doesn't query the logs table anymore, the database is only used for persistence.
+    '''
+
+    def __init__(self) -> None:
+
+        self.lock = threading.Lock()
+        self.attempts:dict[tuple[str, str], dict[str, int]] = {}    # {(module, ip): {service_id: last timestamp}}
+        self.windows:dict[tuple[str, str], int] = {}                # {(module, ip): window in seconds}
+
+        return None
+
+    def add(self, module_name:str, ip:str, service_id:str, timestamp:int, window:int, now:Union[int, None] = None) -> int:
+        """Record an attempt and return the number of distinct service ids in the window
+
+        Args:
+            module_name (str): The module name
+            ip (str): The remote ip address
+            service_id (str): The service id of the attempt
+            timestamp (int): Unixtime of the attempt (time of the event)
+            window (int): The find window of the module in seconds
+            now (int, optional): Current unixtime, a replayed attempt older than the window is not counted. Defaults to timestamp.
+
+        Returns:
+            int: The number of distinct service ids seen in the window
+        """
+        key = (module_name, ip)
+        service_id = str(service_id)
+
+        with self.lock:
+            service_ids = self.attempts.get(key)
+            if service_ids is None:
+                service_ids = self.attempts[key] = {}
+
+            limit = max(timestamp, now or timestamp) - window
+
+            # The events don't arrive in order (many files, replayed offsets and cursors)
+            # a replayed attempt already out of the window is not recorded
+            if timestamp >= limit and timestamp > service_ids.get(service_id, limit - 1):
+                service_ids[service_id] = timestamp
+            self.windows[key] = window
+
+            self.__expire(service_ids, limit)
+
+            return len(service_ids)
+
+    def purge(self, now:int) -> int:
+        """Forget the (module, ip) without any attempt in their window
+
+        Args:
+            now (int): Current unixtime
+
+        Returns:
+            int: The number of (module, ip) removed
+        """
+        removed = 0
+
+        with self.lock:
+            for key in list(self.attempts):
+                service_ids = self.attempts[key]
+                self.__expire(service_ids, now - self.windows[key])
+                if not service_ids:
+                    del self.attempts[key]
+                    del self.windows[key]
+                    removed += 1
+
+        return removed
+
+    def __expire(self, service_ids:dict[str, int], limit:int) -> None:
+
+        # Every entry is checked, the timestamps are not sorted
+        for service_id in [service_id for service_id, timestamp in service_ids.items() if timestamp < limit]:
+            del service_ids[service_id]
+
+        return None
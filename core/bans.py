@@ -0,0 +1,110 @@
+import ipaddress, threading, time
+from typing import Union
+
+class BanRegistry:
+    '''### In-memory registry of the jailed ip addresses
+    Kept in sync with the firewall by Base, it answers "already jailed ?" without forking iptables.
+    A jailed network (CIDR notation) also jails every address inside it.
+    '''
+
+    def __init__(self) -> None:
+
+        self.lock = threading.Lock()
+        self.bans:dict[str, tuple[str, float]] = {}     # {ip: (module name, expiry unixtime)}
+        self.networks:dict[tuple[int, int], set[int]] = {}  # {(ip version, prefix length): {network address}}
+
+        return None
+
+    def add(self, ip:str, module_name:str, duration_seconds:int) -> bool:
+        """Register a jailed ip
+
+        Args:
+            ip (str): The remote ip address
+            module_name (str): The module that jailed the ip
+            duration_seconds (int): The jail duration
+
+        Returns:
+            bool: False if the ip was already jailed
+        """
+        with self.lock:
+            if ip in self.bans:
+                return False
+            self.bans[ip] = (module_name, time.time() + duration_seconds)
+
+            if '/' in ip:
+                network = ipaddress.ip_network(ip, strict=False)
+                self.networks.setdefault((network.version, network.prefixlen), set()).add(int(network.network_address))
+
+        return True
+
+    def remove(self, ip:str) -> bool:
+        """Unregister a released ip
+
+        Args:
+            ip (str): The remote ip address
+
+        Returns:
+            bool: True if the ip was jailed
+        """
+        with self.lock:
+            if self.bans.pop(ip, None) is None:
+                return False
+
+            if '/' in ip:
+                network = ipaddress.ip_network(ip, strict=False)
+                key = (network.version, network.prefixlen)
+                self.networks[key].discard(int(network.network_address))
+                if not self.networks[key]:
+                    del self.networks[key]
+
+        return True
+
+    def is_banned(self, ip:str) -> bool:
+        """Check if the ip is jailed, alone or inside a jailed network
+
+        Args:
+            ip (str): The remote ip address
+
+        Returns:
+            bool: True if the ip is jailed
+        """
+        if ip in self.bans:
+            return True
+
+        if not self.networks:
+            return False
+
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return False
+
+        for (version, prefix_length), network_addresses in list(self.networks.items()):
+            if version != address.version:
+                continue
+            host_bits = address.max_prefixlen - prefix_length
+            if (int(address) >> host_bits) << host_bits in network_addresses:
+                return True
+
+        return False
+
+    def get(self, ip:str) -> Union[tuple[str, float], None]:
+
+        return self.bans.get(ip)
+
+    def items(self) -> list[tuple[str, tuple[str, float]]]:
+
+        with self.lock:
+            return list(self.bans.items())
+
+    def clear(self) -> None:
+
+        with self.lock:
+            self.bans.clear()
+            self.networks.clear()
+
+        return None
+
+    def __len__(self) -> int:
+
+        return len(self.bans)
@@ -1,10 +1,19 @@
-from subprocess import run, PIPE
-import os, sys, threading, time, socket, json, requests, logging
-from datetime import datetime, timedelta
-from sqlalchemy import create_engine, Engine, Connection, CursorResult
+import os, sys, threading, time, socket, json, requests, logging, ipaddress
+from datetime import datetime
+from sqlalchemy import create_engine, event, Engine, Connection, CursorResult
 from sqlalchemy.sql import text
 from platform import python_version
 from typing import Union
+from core.attempts import AttemptTracker
+from core.dbwriter import DbWriter
+from core.bans import BanRegistry
+from core.firewall import FirewallWorker, create_firewall
+from core.migrations import Migrations
+from core.partitions import Partitions
+from core.rollups import Rollups
+from core.scheduler import ReleaseScheduler
+from core.templates import IntrusionTemplates
+from core.whitelist import IpWhitelist
 
 class Base:
     '''### Class contain all the basic methods
@@ -31,18 +40,29 @@ class Base:
         self.hq_communication_freq  = self.getAppConfig('hq_communication_freq')# Frequency in seconds to send data to HQ
         self.default_attempt        = self.getAppConfig('jail_attempt')         # Default attempt before jail
         self.default_jail_duration  = self.getAppConfig('jail_duration')        # Default Duration in seconds before the release
+        self.default_find_window    = self.getAppConfig('find_window') or 86400 # Default window in seconds where the attempts are counted
+        self.keep_bans_on_shutdown  = bool(self.getAppConfig('keep_bans_on_shutdown'))  # Leave the chain and the jailed ip on shutdown
 
         self.CURRENT_PYTHON_VERSION = python_version()                          # Current python version
         self.HOSTNAME               = socket.gethostname()                      # Hostname of the local machine
         self.IPV4                   = socket.gethostbyname(self.HOSTNAME)       # Local ipv4 of the local machine
 
         self.DATE_FORMAT            = '%Y-%m-%d %H:%M:%S'                       # The date format
+        self.RETENTION_CHUNK_SIZE   = 5000                                      # Rows deleted by transaction in clean_db_logs
+        self.RETENTION_TABLES       = {                                         # Tables with a retention: {table: date column}
+            'logs': 'createdOn',                                                # Partitioned by day (Partitions.purge)
+            'iptables_logs': 'createdOn',                                       # Partitioned by day (Partitions.purge)
+            'hq_information': 'COALESCE(updatedOn, createdOn)',
+            'logs_hourly': 'hour'
+        }
         self.api:dict               = {}                                        # Available API's configuration from global.json
         self.default_ipv4           = "0.0.0.0"                                 # Default ipv4 to be used by Interceptor
 
         self.global_whitelisted_ip:list     = []                                # Global Whitelisted ip
         self.local_whitelisted_ip:list      = []                                # Local whitelisted ip (by modules)
         self.whitelisted_ip:list            = []                                # All white listed ip (global and local)
+        self.global_whitelist               = IpWhitelist()                     # Global whitelist lookup (ip and CIDR ranges)
+        self.whitelist                      = IpWhitelist()                     # All whitelist lookup (global and local)
 
         self.default_intcHQ_active    = False                                   # Use head quarter information
         self.default_intcHQ_report    = False                                   # Report to the HQ intrusions
@@ -54,14 +74,26 @@ class Base:
         self.lock = threading.RLock()                                           # Define RLock for multithreading
         self.hb_active:bool = True                                              # Define heartbeat variable
         self.running_threads:list[threading.Thread] = []                        # Define running_threads variable
+        self.attempts = AttemptTracker()                                        # In-memory attempts by module and ip
+        self.bans = BanRegistry()                                               # In-memory jailed ip, in sync with iptables
+        self.scheduler = ReleaseScheduler(self)                                 # Release the jailed ip at their expiry
 
         self.init_log_system()                                                  # Init log system
 
         self.CHAIN_NAME = "INTERCEPTOR"                                         # Define the iptables chain name
+        self.Firewall = create_firewall(self, self.CHAIN_NAME)                  # Firewall backend (iptables, ipset, nftables)
+        self.FirewallWorker = FirewallWorker(self, self.Firewall)               # Batched bans / unbans
         self.iptables_chain_create()                                            # Create the iptables chain
 
         self.engine, self.cursor = self.db_init()                               # Init Engine & Cursor
+        Migrations(self).run()                                                  # Upgrade the schema of an existing database
         self.__db_create_tables()                                               # Create tables
+        self.Partitions = Partitions(self)                                      # Daily partitions of logs and iptables_logs
+        self.Rollups = Rollups(self)                                            # Hourly aggregates of the logs table
+        self.DbWriter = DbWriter(self)                                          # Write-behind of the hot path inserts
+        self.IntrusionTemplates = IntrusionTemplates(self)                      # Deduplicated intrusion_detail
+        self.hq_information = self.db_load_hq_information()                     # In-memory hq_information {ip: (ab_score, hq_totalReports)}
+        self.iptables_load_bans()                                               # Restore the active bans
 
         self.logs.debug(f"Module Base Initiated")
 
@@ -148,18 +180,16 @@ class Base:
         currentdate = datetime.now().strftime(self.DATE_FORMAT)
         return currentdate
 
-    def convert_to_datetime(self, datetime_text:str) -> datetime:
-        """Convertir un datetime de type text en type datetime object
+    def convert_to_sdatetime(self, unixtime:int) -> str:
+        """Convertir un unixtime en date de type text (self.DATE_FORMAT)
 
         Args:
-            datetime_text (str): la date et l'heure a convertir
+            unixtime (int): Epoch seconds
 
         Returns:
-            datetime: datetime object
+            str: date in string format
         """
-        conveted_datetime = datetime.strptime(datetime_text, self.DATE_FORMAT)
-
-        return conveted_datetime
+        return datetime.fromtimestamp(unixtime).strftime(self.DATE_FORMAT)
 
     def convert_to_integer(self, value):
         """Convertit la valeur reçue en entier, si possible.
@@ -179,37 +209,6 @@ class Base:
         except TypeError:
             return value
 
-    def minus_one_hour(self, hours:float) -> str:
-        """Deduct hours from the current datetime
-
-        Args:
-            hours (float): How many hours you want to deduct from the current datetime
-
-        Returns:
-            str: the datetime minus the hour passed in the global format
-        """
-        # '17-02-2024 19:26:16'
-        current_datetime = datetime.now()
-        result_datetime = current_datetime - timedelta(hours=hours)
-
-        result_datetime = result_datetime.strftime(self.DATE_FORMAT)
-
-        return result_datetime
-
-    def add_secondes_to_date(self, date_time:datetime, seconds_duration:int) -> datetime:
-        """Add seconds to the datetime
-
-        Args:
-            date_time (datetime): datetime you want to increment
-            seconds_duration (int): the seconds you want to add
-
-        Returns:
-            datetime: The datetime + the seconds
-        """
-        result = date_time + timedelta(seconds=seconds_duration)
-
-        return result
-
     #################################
     # BEGINNING OF DATABASE METHODS #
     #################################
@@ -227,12 +226,34 @@ class Base:
             os.makedirs(db_directory)
 
         engine = create_engine(f'sqlite:///{db_full_path}', echo=False)
+        event.listen(engine, 'connect', self.db_set_pragmas)
         cursor = engine.connect()
 
         self.logs.debug("Connexion to database ok")
 
         return engine, cursor
 
+    def db_set_pragmas(self, dbapi_connection, connection_record) -> None:
+        """Tune every new sqlite connection
+        - WAL: the readers don't wait for the writer anymore
+        - synchronous NORMAL: no fsync by commit in WAL mode (still safe on application crash)
+        - busy_timeout: wait for the lock instead of failing with "database is locked"
+        - auto_vacuum INCREMENTAL: the pages of the dropped partitions can be given back (applied by Migrations)
+
+        Args:
+            dbapi_connection (sqlite3.Connection): The new DBAPI connection
+            connection_record (ConnectionRecord): The sqlalchemy connection record
+        """
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA busy_timeout=5000')
+        cursor.execute('PRAGMA temp_store=MEMORY')
+        cursor.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        cursor.close()
+
+        return None
+
     def db_execute_query(self, query:str, params:dict = {}) -> CursorResult:
         """Execute a sql query
 
@@ -255,31 +276,11 @@ class Base:
             return response
 
     def __db_create_tables(self) -> None:
-
-        table_logs = f'''CREATE TABLE IF NOT EXISTS logs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            createdOn TEXT,
-            intrusion_service_id TEXT,
-            intrusion_detail TEXT,
-            module_name TEXT,
-            ip_address TEXT,
-            keyword TEXT,
-            user TEXT
-            )
-        '''
-
+        """Create the tables, logs and iptables_logs are created by Partitions (one table by day)
+        """
         table_iptables = f'''CREATE TABLE IF NOT EXISTS iptables (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
-            createdOn TEXT,
-            module_name TEXT,
-            ip_address TEXT,
-            duration INTEGER
-            )
-        '''
-
-        table_iptables_logs = f'''CREATE TABLE IF NOT EXISTS iptables_logs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            createdOn TEXT,
+            createdOn INTEGER,
             module_name TEXT,
             ip_address TEXT,
             duration INTEGER
@@ -288,8 +289,8 @@ class Base:
 
         table_hq_information = f'''CREATE TABLE IF NOT EXISTS hq_information (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
-            createdOn TEXT,
-            updatedOn TEXT,
+            createdOn INTEGER,
+            updatedOn INTEGER,
             ip_address TEXT,
             ab_score INTEGER,
             hq_totalReports INTEGER
@@ -298,82 +299,142 @@ class Base:
 
         table_hq_information_to_report = f'''CREATE TABLE IF NOT EXISTS hq_information_to_report (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
-            createdOn TEXT,
+            createdOn INTEGER,
             id_log INTEGER
         )'''
 
-        a = self.db_execute_query(table_logs)
-        b = self.db_execute_query(table_iptables)
-        c = self.db_execute_query(table_iptables_logs)
-        d = self.db_execute_query(table_hq_information)
-        e = self.db_execute_query(table_hq_information_to_report)
+        table_intrusion_templates = f'''CREATE TABLE IF NOT EXISTS intrusion_templates (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            template TEXT UNIQUE
+        )'''
 
-        creation = a.rowcount + b.rowcount + c.rowcount + d.rowcount + e.rowcount
+        table_logs_hourly = f'''CREATE TABLE IF NOT EXISTS logs_hourly (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            hour INTEGER,
+            module_name TEXT,
+            keyword TEXT,
+            ip_address TEXT,
+            prefix TEXT,
+            attempts INTEGER
+        )'''
+
+        table_rollups = f'''CREATE TABLE IF NOT EXISTS rollups (
+            table_name TEXT PRIMARY KEY,
+            rolled_until INTEGER
+        )'''
+
+        a = self.db_execute_query(table_iptables)
+        b = self.db_execute_query(table_hq_information)
+        c = self.db_execute_query(table_hq_information_to_report)
+        d = self.db_execute_query(table_intrusion_templates)
+        e = self.db_execute_query(table_logs_hourly)
+        f = self.db_execute_query(table_rollups)
+
+        creation = a.rowcount + b.rowcount + c.rowcount + d.rowcount + e.rowcount + f.rowcount
         if creation > 0:
             self.logs.debug("Table creation OK")
 
+        self.__db_create_indexes()
+
+        return None
+
+    def __db_create_indexes(self) -> None:
+        """Create the indexes used by the hot queries (the indexes of the partitions are created by Partitions)
+        hq_information keeps one row by ip address (the most recent one), enforced by a unique index
+        """
+        query_hq_information_duplicates = '''DELETE FROM hq_information
+                    WHERE id NOT IN (SELECT MAX(id) FROM hq_information GROUP BY ip_address)
+                '''
+        duplicates = self.db_execute_query(query_hq_information_duplicates).rowcount
+        if duplicates > 0:
+            self.logs.info(f'{duplicates} duplicated ip removed from hq_information')
+
+        indexes = [
+            'CREATE UNIQUE INDEX IF NOT EXISTS idx_hq_information_ip_address ON hq_information (ip_address)',
+            'CREATE INDEX IF NOT EXISTS idx_iptables_ip_address ON iptables (ip_address)',
+            'CREATE INDEX IF NOT EXISTS idx_iptables_createdOn ON iptables (createdOn)',
+            'CREATE INDEX IF NOT EXISTS idx_hq_information_to_report_id_log ON hq_information_to_report (id_log)',
+            'CREATE UNIQUE INDEX IF NOT EXISTS idx_logs_hourly_hour ON logs_hourly (hour, module_name, keyword, ip_address)'
+        ]
+
+        for index in indexes:
+            self.db_execute_query(index)
+
+        self.db_execute_query('PRAGMA optimize')
+
         return None
 
     def db_record_ip(self, service_id:str, intrusion_detail:str, module_name:str, ip:str, keyword:str, user:str) -> bool:
         """Record an ip into the logs table
+        logs.intrusion_detail is NULL when the line is stored as a template, use IntrusionTemplates.decode to read it
 
         Args:
             service_id (str): The service id
+            intrusion_detail (str): The raw line
             module_name (str): The module name
             ip (str): The remote ip address
             keyword (str): The keyword
             user (str): The user attempt
 
         Returns:
-            int: The number of rows affected
+            bool: True when the record is queued
         """
-        response = False
-        current_datetime = self.get_sdatetime()
-        query = '''INSERT INTO logs (createdOn, intrusion_service_id, intrusion_detail, module_name, ip_address, keyword, user) 
-                VALUES (:datetime, :intrusion_service_id, :intrusion_detail, :module_name, :ip, :keyword, :user)
+        current_datetime = self.get_unixtime()
+        query = f'''INSERT INTO {self.Partitions.get_table('logs', current_datetime)} (id, createdOn, intrusion_service_id, intrusion_detail, module_name, ip_address, keyword, user, intrusion_template_id, intrusion_variables) 
+                VALUES (:id, :datetime, :intrusion_service_id, :intrusion_detail, :module_name, :ip, :keyword, :user, :intrusion_template_id, :intrusion_variables)
                 '''
+        # Only the variables of the line (and the user) are stored, the template is shared (IntrusionTemplates.decode)
+        template_id, variables, raw_detail = self.IntrusionTemplates.encode(intrusion_detail, (user,))
+        # The id is allocated in memory, the row is written later by the DbWriter
+        log_id = self.DbWriter.next_log_id()
         mes_donnees = {
+                        'id': log_id,
                         'datetime': current_datetime,
                         'intrusion_service_id': service_id,
-                        'intrusion_detail': intrusion_detail,
+                        'intrusion_detail': raw_detail,
                         'module_name':module_name,
                         'ip': ip,
                         'keyword':keyword,
-                        'user':user
+                        'user':user,
+                        'intrusion_template_id': template_id,
+                        'intrusion_variables': variables
                         }
 
-        r = self.db_execute_query(query, mes_donnees)
-        row_affected_logs = r.rowcount
-        lastLogId = r.lastrowid
+        self.DbWriter.write(query, mes_donnees)
 
         query_hq_info_to_report = 'INSERT INTO hq_information_to_report (createdOn, id_log) VALUES (:createdOn, :id_log)'
-        lastLogId = lastLogId if type(self.convert_to_integer(lastLogId)) == int else 0
         query_data = {
             'createdOn': current_datetime,
-            'id_log': lastLogId
+            'id_log': log_id
         }
 
-        row_affeced_hq = 0
-        if lastLogId > 0:
-            c = self.db_execute_query(query_hq_info_to_report, query_data)
-            row_affeced_hq = c.rowcount
-
-        if (row_affeced_hq + row_affected_logs) > 0:
-            response = True
+        self.DbWriter.write(query_hq_info_to_report, query_data)
 
         self.logs.info(f'{module_name} - {keyword} - {service_id} - {ip} - {user} - recorded')
 
-        return response
+        return True
+
+    def db_load_hq_information(self) -> dict[str, tuple[int, int]]:
+        """Load hq_information in memory, the hot path never reads the table
+
+        Returns:
+            dict[str, tuple[int, int]]: {ip_address: (ab_score, hq_totalReports)}
+        """
+        query = 'SELECT ip_address, ab_score, hq_totalReports FROM hq_information'
+
+        return {ip_address: (ab_score, hq_totalReports) for ip_address, ab_score, hq_totalReports in self.db_execute_query(query).fetchall()}
 
     def db_record_hq_information(self, ip_address:str, ab_score:int, hq_totalReports:int) -> bool:
 
         response = False
-        createdOn = self.get_sdatetime()
+        createdOn = self.get_unixtime()
         ab_score:int = ab_score if type(self.convert_to_integer(ab_score)) == int else 0
         hq_totalReports:int = hq_totalReports if type(self.convert_to_integer(hq_totalReports)) == int else 0
 
         query = """INSERT INTO hq_information (createdOn, ip_address, ab_score, hq_totalReports) 
         VALUES (:createdOn, :ip_address, :ab_score, :hq_totalReports)
+        ON CONFLICT (ip_address) DO UPDATE SET
+            updatedOn = excluded.createdOn, ab_score = excluded.ab_score, hq_totalReports = excluded.hq_totalReports
         """
 
         query_data = {
@@ -386,6 +447,7 @@ class Base:
         r = self.db_execute_query(query, query_data)
 
         if r.rowcount > 0:
+            self.hq_information[ip_address] = (ab_score, hq_totalReports)
             response = True
 
         return response
@@ -399,20 +461,20 @@ class Base:
             duration (int): The ban duration
 
         Returns:
-            int: The number of rows affected
+            int: The number of rows queued
         """
         query = '''INSERT INTO iptables (createdOn, module_name, ip_address, duration) 
                 VALUES (:datetime, :module_name, :ip, :duration)
                 '''
         mes_donnees = {
-                        'datetime': self.get_sdatetime(),
+                        'datetime': self.get_unixtime(),
                         'module_name':module_name,
                         'ip': ip,
                         'duration':duration
                         }
 
-        r = self.db_execute_query(query, mes_donnees)
-        return r.rowcount
+        self.DbWriter.write(query, mes_donnees)
+        return 1
 
     def db_record_iptables_logs(self, module_name:str, ip:str, duration:int) -> int:
         """Record the remote ip address that has been jailed
@@ -423,20 +485,21 @@ class Base:
             duration (int): The duration of the jail
 
         Returns:
-            int: The number of rows affected
+            int: The number of rows queued
         """
-        query = '''INSERT INTO iptables_logs (createdOn, module_name, ip_address, duration) 
+        current_datetime = self.get_unixtime()
+        query = f'''INSERT INTO {self.Partitions.get_table('iptables_logs', current_datetime)} (createdOn, module_name, ip_address, duration) 
                 VALUES (:datetime, :module_name, :ip, :duration)
                 '''
         mes_donnees = {
-                        'datetime': self.get_sdatetime(),
+                        'datetime': current_datetime,
                         'module_name':module_name,
                         'ip': ip,
                         'duration':duration
                         }
 
-        r = self.db_execute_query(query, mes_donnees)
-        return r.rowcount
+        self.DbWriter.write(query, mes_donnees)
+        return 1
 
     def db_remove_iptables(self, ip:str) -> int:
         """Remove remote ip address from the iptables table
@@ -446,63 +509,142 @@ class Base:
             ip (str): The remote ip address
 
         Returns:
-            int: The number of rows affected
+            int: The number of rows queued
         """
         query = '''DELETE FROM iptables WHERE ip_address = :ip'''
 
         mes_donnees = {'ip': ip}
 
-        r = self.db_execute_query(query, mes_donnees)
-        rowcount = r.rowcount
+        # Queued after the insert of the ip, the DbWriter keeps the order
+        self.DbWriter.write(query, mes_donnees)
 
-        return rowcount
+        return 1
+
+    def db_load_attempts(self, windows:dict[str, int]) -> int:
+        """Load the attempts of the find window from the logs table into the in-memory tracker
+
+        Args:
+            windows (dict[str, int]): {module name: find window in seconds}
+
+        Returns:
+            int: The number of attempts loaded
+        """
+        if not windows:
+            return 0
+
+        query = '''SELECT module_name, ip_address, intrusion_service_id, createdOn
+                    FROM logs
+                    WHERE createdOn >= :datetime
+                    ORDER BY id
+                '''
+        mes_donnees = {'datetime': self.get_unixtime() - max(windows.values())}
+
+        cursorResult = self.db_execute_query(query, mes_donnees)
+        loaded = 0
+
+        for db_module_name, db_ip, db_service_id, db_unixtime in cursorResult.fetchall():
+            if not db_module_name in windows:
+                continue
+            self.attempts.add(db_module_name, db_ip, db_service_id, db_unixtime, windows[db_module_name])
+            loaded += 1
+
+        self.logs.debug(f'{loaded} attempts loaded from the logs table')
+
+        return loaded
+
+    def db_delete_chunked(self, table_name:str, condition:str, params:dict = {}) -> int:
+        """Delete the rows matching the condition, RETENTION_CHUNK_SIZE rows by transaction
+        the lock is released between two chunks so the detection is never stalled
+
+        Args:
+            table_name (str): The table name
+            condition (str): The WHERE condition of the rows to delete
+            params (dict, optional): The parameters of the condition. Defaults to {}.
+
+        Returns:
+            int: The number of rows deleted
+        """
+        query = f'''DELETE FROM {table_name} WHERE id IN (
+                        SELECT id FROM {table_name} WHERE {condition} LIMIT :chunk_size
+                    )
+                '''
+        mes_donnees = dict(params, chunk_size=self.RETENTION_CHUNK_SIZE)
+        deleted = 0
+
+        while True:
+            rowcount = self.db_execute_query(query, mes_donnees).rowcount
+            deleted += rowcount
+            if rowcount < self.RETENTION_CHUNK_SIZE:
+                break
+            time.sleep(0)
+
+        return deleted
 
     def clean_db_logs(self) -> bool:
-        """Clean logs that they have more than 24 hours
+        """Clean the rows older than the retention of their table (retention_hours in configuration.json)
+        then the default ip, the whitelisted ip, the orphan rows of hq_information_to_report and the unused intrusion_templates
+        the complete hours of the logs table are folded into logs_hourly before
         """
         response = False
-        query = "DELETE FROM logs WHERE ip_address = :ip"
-        query_hq_information = "DELETE FROM hq_information WHERE ip_address = :ip"
+
+        self.Rollups.run()
+
+        # Retention by table, logs: 24 hours and logs_hourly: 90 days if not configured
+        retention_hours = self.getAppConfig('retention_hours')
+        retention_hours = dict(retention_hours) if type(retention_hours) == dict else {}
+        retention_hours.setdefault('logs', 24)
+        retention_hours.setdefault('logs_hourly', 2160)
+
+        affected_rows = 0
+
+        # The partitioned tables are always purged: without retention, only the partitions above MAX_PARTITIONS are dropped
+        for table_name in self.Partitions.PARTITIONED_TABLES:
+            hours = retention_hours.get(table_name)
+            retention_limit = None if hours is None else self.get_unixtime() - int(float(hours) * 3600)
+            affected_rows += self.Partitions.purge(table_name, retention_limit)
+
+        for table_name, hours in retention_hours.items():
+            if not table_name in self.RETENTION_TABLES or table_name in self.Partitions.PARTITIONED_TABLES or hours is None:
+                continue
+            retention_limit = self.get_unixtime() - int(float(hours) * 3600)
+            condition = f'{self.RETENTION_TABLES[table_name]} <= :datetime'
+            affected_rows += self.db_delete_chunked(table_name, condition, {'datetime': retention_limit})
+
         mes_donnees = {'ip': self.default_ipv4}
-        default_ip_request = self.db_execute_query(query,mes_donnees)
+        affected_rows_default_ipv4 = self.Partitions.delete('logs', 'ip_address = :ip', mes_donnees)
 
-        # Clean whitelisted ip from the database
+        # Clean whitelisted ip (and ip inside the whitelisted ranges) from the database
         affected_whitelisted_ip = 0
-        for whitelisted_ip in self.whitelisted_ip:
-            my_data = {'ip': whitelisted_ip}
-            whitelisted_fetch = self.db_execute_query(query, my_data)
-            affected_whitelisted_ip += whitelisted_fetch.rowcount
-
-            whitelisted_fetch_hq = self.db_execute_query(query_hq_information, my_data)
-            affected_whitelisted_ip += whitelisted_fetch_hq.rowcount
-
-        query_hq_info_to_report = """SELECT 
-                        hir.id as 'id',
-                        l.ip_address as 'ip_address'
-                    FROM hq_information_to_report hir
-                    LEFT JOIN logs l ON l.id = hir.id_log
-                    WHERE l.id IS NULL
-                    """
-        hq_info_to_report_fetch = self.db_execute_query(query_hq_info_to_report)
-        query_delete = "DELETE FROM hq_information_to_report WHERE id = :id"
-
-        affected_ip_to_report = 0
-        for record in hq_info_to_report_fetch.fetchall():
-            db_id, db_ip_address = record
-            if db_ip_address is None:
-                r_delete_to_report = self.db_execute_query(query_delete, {'id': db_id})
-                affected_ip_to_report += r_delete_to_report.rowcount
-
-        query = 'DELETE FROM logs WHERE createdOn <= :datetime'
-        mes_donnees = {'datetime': self.minus_one_hour(24)}
-        r_datetime = self.db_execute_query(query, mes_donnees)
-
-        affected_rows = r_datetime.rowcount
-        affected_rows_default_ipv4 = default_ip_request.rowcount
-        affected = affected_rows + affected_rows_default_ipv4 + affected_whitelisted_ip + affected_ip_to_report
+        query_recorded_ip = "SELECT ip_address FROM logs UNION SELECT ip_address FROM hq_information"
+        whitelisted_ips = [recorded_ip for recorded_ip, in self.db_execute_query(query_recorded_ip).fetchall() if recorded_ip in self.whitelist]
+
+        # 500 ip by statement, below the sqlite limit of variables
+        for position in range(0, len(whitelisted_ips), 500):
+            ips = whitelisted_ips[position:position + 500]
+            my_data = {f'ip{i}': ip for i, ip in enumerate(ips)}
+            condition = f"ip_address IN ({', '.join(f':ip{i}' for i in range(len(ips)))})"
+            affected_whitelisted_ip += self.Partitions.delete('logs', condition, my_data)
+            affected_whitelisted_ip += self.db_delete_chunked('hq_information', condition, my_data)
+
+        # hq_information_to_report rows whose log has been deleted
+        condition = 'NOT EXISTS (SELECT 1 FROM logs l WHERE l.id = hq_information_to_report.id_log)'
+        affected_ip_to_report = self.db_delete_chunked('hq_information_to_report', condition)
+
+        # intrusion_templates no log references anymore
+        affected_templates = self.IntrusionTemplates.purge()
+
+        # The rows of hq_information removed by the retention and the whitelist
+        self.hq_information = self.db_load_hq_information()
+
+        # Bounded, the pages left are given back by the next cycles
+        vacuumed_pages = self.Partitions.vacuum()
+        if vacuumed_pages > 0:
+            self.logs.debug(f'clean_db_logs - {vacuumed_pages} free pages given back to the file system')
+
+        affected = affected_rows + affected_rows_default_ipv4 + affected_whitelisted_ip + affected_ip_to_report + affected_templates
 
         if affected > 0:
-            self.logs.info(f'clean_db_logs - Deleted : Logs {str(affected_rows)} | Default ip {affected_rows_default_ipv4} | WhiteListed IP {affected_whitelisted_ip} | Ip to report {affected_ip_to_report}')
+            self.logs.info(f'clean_db_logs - Deleted : Logs {str(affected_rows)} | Default ip {affected_rows_default_ipv4} | WhiteListed IP {affected_whitelisted_ip} | Ip to report {affected_ip_to_report} | Templates {affected_templates}')
             response = True
 
         return response
@@ -535,7 +677,7 @@ class Base:
         """
         while self.hb_active:
             time.sleep(beat)
-            self.clean_iptables()
+            self.attempts.purge(self.get_unixtime())
             self.logs.debug(f"Running Heartbeat every {beat} seconds")
 
         return None
@@ -560,159 +702,188 @@ class Base:
     #################################
 
     def iptables_chain_create(self) -> bool:
-        """Create a chain for Interceptor
+        """Create the chain (and the sets) of the firewall backend
         """
+        self.Firewall.setup()
 
-        chain_name = self.CHAIN_NAME
+        return True
 
-        self.iptables_remove_existing_rules()
+    def iptables_load_bans(self) -> int:
+        """Restore the active bans of the iptables table with their remaining duration
+        and schedule their release, in one firewall transaction:
+        - jailed in the table but missing in the firewall (chain removed on shutdown): jailed again
+        - expired while Interceptor was stopped: released and removed from the table
+        - in the firewall without record in the table: released, they can't be released anymore
 
-        # If chain_name equal to INPUT then do not create chain
-        if chain_name == 'INPUT':
-            self.logs.debug(f"Default chain [INPUT]")
-            return False
+        Returns:
+            int: The number of jailed ip restored
+        """
+        chain_name = self.CHAIN_NAME
 
-        # Create the chain
-        system_command = f'/sbin/iptables -N {chain_name}'
-        os.system(system_command)
-        self.logs.debug(f"Creating chain: [{chain_name}]")
+        query = 'SELECT ip_address, module_name, createdOn + duration - :unixtime FROM iptables'
+        db_bans:dict[str, tuple[str, int]] = {}
+        for db_ip, db_module_name, db_remaining_seconds in self.db_execute_query(query, {'unixtime': self.get_unixtime()}).fetchall():
+            db_bans[db_ip] = (db_module_name, int(db_remaining_seconds))
 
-        add_chain_to_input = f'/sbin/iptables -A INPUT -j {chain_name}'
-        os.system(add_chain_to_input)
-        self.logs.debug(f"Adding the chain [{chain_name}] to INPUT")
+        firewall_bans = set(self.Firewall.list_bans())
+        operations:list[tuple[str, str, int]] = []
 
-        self.logs.debug(f"Iptables chain [{chain_name}] created.")
+        for db_ip, (db_module_name, remaining_seconds) in db_bans.items():
+            if remaining_seconds <= 0:
+                if db_ip in firewall_bans and not self.Firewall.kernel_expiry:
+                    operations.append(('unban', db_ip, 0))
+                self.db_remove_iptables(db_ip)
+                self.logs.info(f'{db_module_name} - "{db_ip}" - released from jail')
+                continue
 
-        return True
+            self.bans.add(db_ip, db_module_name, remaining_seconds)
+            if not db_ip in firewall_bans:
+                operations.append(('ban', db_ip, remaining_seconds))
 
-    def iptables_chain_isExist(self, name:str) -> bool:
-        """Check if the chain name exist or not
+        for ip in firewall_bans:
+            if not ip in db_bans:
+                operations.append(('unban', ip, 0))
+                self.logs.info(f'"{ip}" - no record in the iptables table, released from jail')
 
-        Args:
-            name (str): The name of the chain
+        if operations:
+            for ip in self.Firewall.apply(operations):
+                self.ip_tables_ban_failed(ip)
 
-        Returns:
-            bool: True if the chain name already exist.
-        """
+        for ip, (db_module_name, expiry) in self.bans.items():
+            self.scheduler.schedule(ip, expiry)
 
-        check_rule = run(['/sbin/iptables','-N', name],stdout=PIPE, stderr=PIPE).returncode == 0
-        response = False
+        self.logs.info(f'{len(self.bans)} jailed ip restored in the chain [{chain_name}] ({len(operations)} firewall operations)')
 
-        if check_rule:
-            response = True
+        return len(self.bans)
 
-        return response
+    def ip_tables_add(self, module_name:str, ip:str, duration_seconds:int) -> int:
 
-    def iptables_count_interceptor_occurence(self) -> int:
+        # Already jailed: answered by the registry, no firewall fork
+        if not self.bans.add(ip, module_name, duration_seconds):
+            return 0
 
-        run_command = run(['/sbin/iptables', '-S'], capture_output=True, text=True)
-        output = run_command.stdout.splitlines()
-        number_of_occurence:list = []
+        return self.__ip_tables_jail(module_name, ip, duration_seconds)
 
-        for int_occurence in output:
-            if '-A INPUT -j INTERCEPTOR' in int_occurence:
-                number_of_occurence.append(int_occurence)
+    def ip_tables_add_network(self, module_name:str, network:str, duration_seconds:int) -> int:
+        """Jail a whole network and release the jailed ip (or smaller networks) inside it
 
-        return len(number_of_occurence)
+        Args:
+            module_name (str): The module name
+            network (str): The network in CIDR notation
+            duration_seconds (int): The jail duration
 
-    def iptables_remove_existing_rules(self) -> bool:
+        Returns:
+            int: The number of rows affected (0 if the network was already jailed)
+        """
+        if not self.bans.add(network, module_name, duration_seconds):
+            return 0
 
-        number_of_occurence = self.iptables_count_interceptor_occurence()
-        chain_name = self.CHAIN_NAME
+        jailed_network = ipaddress.ip_network(network, strict=False)
 
-        for i in range(0, number_of_occurence):
-            os.system(f'/sbin/iptables -D INPUT -j {chain_name}')
+        # The unbans are queued before the ban of the network: nftables refuses overlapping elements (flags interval)
+        for ip, (db_module_name, expiry) in self.bans.items():
+            if ip == network:
+                continue
 
-        return True
+            jailed_ip = ipaddress.ip_network(ip, strict=False)
+            if jailed_ip.version == jailed_network.version and jailed_ip.subnet_of(jailed_network):
+                self.ip_tables_remove(ip)
+                self.db_remove_iptables(ip)
+                self.logs.info(f'{db_module_name} - "{ip}" - absorbed by the jailed network "{network}"')
 
-    def ip_tables_add(self, module_name:str, ip:str, duration_seconds:int) -> int:
+        return self.__ip_tables_jail(module_name, network, duration_seconds)
 
-        chain_name = self.CHAIN_NAME
+    def __ip_tables_jail(self, module_name:str, ip:str, duration_seconds:int) -> int:
+        """Schedule the release, queue the ban and record the ip already added to the registry
 
-        if self.ip_tables_isExist(ip):
-            return 0
+        Args:
+            module_name (str): The module name
+            ip (str): The ip address or the network
+            duration_seconds (int): The jail duration
+
+        Returns:
+            int: The number of rows affected
+        """
+        self.scheduler.schedule(ip, self.bans.get(ip)[1])
 
-        system_command = f'/sbin/iptables -A {chain_name} -s {ip} -j REJECT'
-        os.system(system_command)
+        self.FirewallWorker.ban(ip, duration_seconds)
         rowcount = self.db_record_iptables(module_name, ip, duration_seconds)
         self.db_record_iptables_logs(module_name, ip, duration_seconds)
         return rowcount
 
     def ip_tables_remove(self, ip:str) -> None:
 
-        chain_name = self.CHAIN_NAME
-
-        system_command = f'/sbin/iptables -D {chain_name} -s {ip} -j REJECT'
-        os.system(system_command)
+        self.bans.remove(ip)
+        self.FirewallWorker.unban(ip)
         return None
 
-    def ip_tables_reset(self) -> None:
+    def ip_tables_ban_failed(self, ip:str) -> None:
+        """Roll back a ban refused by the firewall (set full, overlapping element ...)
 
-        chain_name = self.CHAIN_NAME
+        Args:
+            ip (str): The ip address or the network
+        """
+        ban = self.bans.get(ip)
+        if ban is None:
+            return None
 
-        # clean ip in the chain
-        system_command = f'/sbin/iptables -F {chain_name}'
-        os.system(system_command)
-        self.logs.info(f"Removing IPs from chain: [{chain_name}]")
+        self.bans.remove(ip)
+        self.db_remove_iptables(ip)
+        self.logs.error(f'{ban[0]} - "{ip}" - the firewall refused the ban, not jailed')
 
-        # Delete existing rules
-        self.iptables_remove_existing_rules()
-        self.logs.info(f"Removing rules from INPUT: [{chain_name}]")
+        return None
 
-        # Remove chain
-        system_command = f'/sbin/iptables -X {chain_name}'
-        os.system(system_command)
-        self.logs.info(f"Removing chain: [{chain_name}]")
+    def ip_tables_stop(self) -> None:
+        """Stop the release scheduler and apply the pending firewall operations
+        the jailed ip stay in the firewall
+        """
+        self.scheduler.stop()
+        self.FirewallWorker.stop()
 
-        self.logs.info("iptables has been cleared")
         return None
 
-    def ip_tables_isExist(self, ip:str) -> bool:
-        """Vérifie si une ip existe dans iptables
+    def ip_tables_reset(self) -> None:
 
-        Args:
-            ip (str): l'adresse ip
+        self.ip_tables_stop()
+        self.Firewall.reset()
+        self.bans.clear()
 
-        Returns:
-            bool: True si l'ip existe déja
-        """
-        chain_name = self.CHAIN_NAME
-        # check_rule = run(['/sbin/iptables','-C','INPUT','-s',ip,'-j','REJECT'],stdout=subprocess.PIPE, stderr=subprocess.PIPE).returncode == 0
-        check_rule = run(['/sbin/iptables','-C', chain_name,'-s', ip,'-j','REJECT'],stdout=PIPE, stderr=PIPE).returncode == 0
-        response = False
+        self.logs.info(f"{self.Firewall.name} has been cleared")
+        return None
 
-        if check_rule:
-            response = True
+    def ip_tables_release(self, ip:str) -> bool:
+        """Release the ip if its jail duration is expired
+        called by the release scheduler
 
-        return response
+        Args:
+            ip (str): The jailed ip address
 
-    def clean_iptables(self) -> None:
-        """Clean iptables db table and iptables
-        release remote ip address when the duration is expired
+        Returns:
+            bool: True if the ip has been released
         """
-        query = f'''SELECT ip_address, createdOn, duration, module_name 
-                    FROM iptables
-                '''
+        ban = self.bans.get(ip)
 
-        cursorResult = self.db_execute_query(query)
-        r = cursorResult.fetchall()
+        # Already released or jailed again since the entry was scheduled
+        if ban is None or ban[1] > time.time():
+            return False
 
-        for result in r:
-            db_ip, db_datetime, db_duration, db_module_name = result
-            datetime_object = self.convert_to_datetime(db_datetime)
-            dtime_final = self.add_secondes_to_date(datetime_object, db_duration)
+        db_module_name = ban[0]
 
-            if self.get_datetime() > dtime_final:
-                self.db_remove_iptables(db_ip)
-                self.ip_tables_remove(db_ip)
-                self.logs.info(f'{db_module_name} - "{db_ip}" - released from jail')
+        if self.Firewall.kernel_expiry:
+            # The kernel already released the ip, only the registry and the table are cleaned
+            self.bans.remove(ip)
+        else:
+            self.ip_tables_remove(ip)
 
-        return None
+        self.db_remove_iptables(ip)
+        self.logs.info(f'{db_module_name} - "{ip}" - released from jail')
+
+        return True
 
     # END OF IPTABLES METHODS #
 
     def get_internal_hq_info(self, ip_address:str) -> Union[tuple[int, int], tuple[None, None]]:
-        """Fetch local database to retrieve ab_score and hq_totalReports
+        """Retrieve ab_score and hq_totalReports from the in-memory hq_information (no database access)
 
         Args:
             ip_address (str): remote ip address
@@ -720,45 +891,40 @@ class Base:
         Returns:
             Union[tuple[int, int], None]: (ab_score, hq_totalReports) or None
         """
-        query = 'SELECT ab_score, hq_totalReports FROM hq_information WHERE ip_address = :ip_address'
-        param_query = {'ip_address': ip_address}
-
-        fetch_query = self.db_execute_query(query, param_query)
-        result_query = fetch_query.fetchone()
-
-        if not result_query is None:
-            ab_score, hq_totalReports = result_query
-            return ab_score, hq_totalReports
-        else:
-            return None, None
+        return self.hq_information.get(ip_address, (None, None))
 
     def thread_report_to_HQ_v2(self) -> None:
         """### 1. Get data from local database
         ### 2. Send it to HQ every 1.5 seconds
-        ### 3. Check whether the ip is in the table hq_information
-        ###     3.1 Record the ip and the information received from HQ (if no record available)
-        ###     3.2 Edit the information if the record is available
+        ### 3. Record the ip and the information received from HQ in hq_information and in memory
+        ###     (or edit the record if the ip is already available, one upsert)
         ### 4. Delete the record from the local database
         """
-        current_date = self.get_sdatetime()
+        current_date = self.get_unixtime()
+
+        query_hq_info_to_report = 'SELECT id_log FROM hq_information_to_report'
 
-        query_hq_info_to_report = '''SELECT 
+        # One lookup by id: pushed down to the primary key of every partition of the logs view
+        # (a join with the view would materialize all the partitions)
+        query_log = '''SELECT 
                         l.id as 'id_log',
                         l.createdOn as 'log_createdOn',
                         l.intrusion_service_id,
                         l.intrusion_detail,
+                        l.intrusion_template_id,
+                        l.intrusion_variables,
                         l.module_name,
                         l.ip_address,
                         l.keyword
-                    FROM hq_information_to_report hir
-                    LEFT JOIN logs l ON l.id = hir.id_log
+                    FROM logs l
+                    WHERE l.id = :id_log
                     '''
 
-        query_get_hq_info_select = 'SELECT id FROM hq_information WHERE ip_address = :ip_address'
-        query_get_hq_info_insert = '''INSERT INTO hq_information (createdOn, updatedOn, ip_address, ab_score, hq_totalReports) 
+        query_get_hq_info_upsert = '''INSERT INTO hq_information (createdOn, updatedOn, ip_address, ab_score, hq_totalReports) 
         VALUES (:createdOn, :updatedOn, :ip_address, :ab_score, :hq_totalReports)
+        ON CONFLICT (ip_address) DO UPDATE SET
+            ab_score = excluded.ab_score, hq_totalReports = excluded.hq_totalReports, updatedOn = excluded.updatedOn
         '''
-        query_get_hq_info_update = 'UPDATE hq_information SET ab_score = :ab_score, hq_totalReports = :hq_totalReports, updatedOn = :updatedOn WHERE ip_address = :ip_address'
         query_delete = 'DELETE FROM hq_information_to_report WHERE id_log = :id_to_delete'
 
         fetch_query = self.db_execute_query(query_hq_info_to_report)
@@ -767,16 +933,23 @@ class Base:
         if not result_query:
             return None
 
-        for result in result_query:
+        for id_log, in result_query:
+            result = self.db_execute_query(query_log, {'id_log': id_log}).fetchone()
+
+            # The log has been deleted, the row is removed by clean_db_logs
+            if result is None:
+                continue
+
             try:
-                db_id_log, intrusion_date, intrusion_service_id, intrustion_detail, db_mod_name, db_ip_address, db_keyword = result
+                db_id_log, intrusion_date, intrusion_service_id, db_intrusion_detail, db_template_id, db_variables, db_mod_name, db_ip_address, db_keyword = result
+                intrustion_detail = self.IntrusionTemplates.decode(db_intrusion_detail, db_template_id, db_variables)
 
                 # If ip is None then loop
                 if db_ip_address is None:
                     continue
 
                 # Report the information to HQ
-                hq_response = self.report_to_HQ_v2(intrusion_date, intrustion_detail, db_ip_address, intrusion_service_id, db_mod_name, db_keyword)
+                hq_response = self.report_to_HQ_v2(self.convert_to_sdatetime(intrusion_date), intrustion_detail, db_ip_address, intrusion_service_id, db_mod_name, db_keyword)
 
                 if hq_response is None or not hq_response:
                     continue
@@ -791,20 +964,10 @@ class Base:
                 ab_score:int = hq_response['ab_score'] if type(self.convert_to_integer(hq_response['ab_score'])) == int else 0
                 hq_totalReports:int = hq_response['hq_totalReports'] if type(self.convert_to_integer(hq_response['hq_totalReports'])) == int else 0
 
-                # Check if ip is available locally
-                param_get_hq_info_select = {'ip_address': db_ip_address}
-                fetch_is_ip_available = self.db_execute_query(query_get_hq_info_select, param_get_hq_info_select)
-                result_is_ip_available = fetch_is_ip_available.fetchone()
-
-                # if ip not available then record it
-                if result_is_ip_available is None:
-                    param_get_hq_info_insert = {'createdOn': current_date, 'updatedOn': current_date, 'ip_address': db_ip_address, 'ab_score': ab_score, 'hq_totalReports': hq_totalReports}
-                    self.db_execute_query(query_get_hq_info_insert, param_get_hq_info_insert)
-
-                # if ip is available then update the record
-                else:
-                    param_get_hq_info_update = {'ab_score': ab_score, 'hq_totalReports': hq_totalReports, 'updatedOn': current_date, 'ip_address': db_ip_address}
-                    self.db_execute_query(query_get_hq_info_update, param_get_hq_info_update)
+                # Record the ip or update its record (one row by ip address)
+                param_get_hq_info_upsert = {'createdOn': current_date, 'updatedOn': current_date, 'ip_address': db_ip_address, 'ab_score': ab_score, 'hq_totalReports': hq_totalReports}
+                self.db_execute_query(query_get_hq_info_upsert, param_get_hq_info_upsert)
+                self.hq_information[db_ip_address] = (ab_score, hq_totalReports)
 
                 time.sleep(1.5)
 
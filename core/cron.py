@@ -16,7 +16,10 @@ class Cron:
         intc_hq_status = self.Base.api['intc_hq']['active'] if 'intc_hq' in self.Base.api else False
         intc_hq_report = self.Base.api['intc_hq']['report'] if 'intc_hq' in self.Base.api else False
 
-        # Initialiser heartbeat
+        # Initialiser le worker du firewall et heartbeat
+        self.Base.create_thread(self.Base.FirewallWorker.run, func_name='FirewallWorker')
+        self.Base.create_thread(self.Base.DbWriter.run, func_name='DbWriter')
+        self.Base.create_thread(self.Base.scheduler.run, func_name='ReleaseScheduler')
         self.Base.create_thread(self.Base.heartbeat, func_args=(self.Base.PULSE, ), func_name='Heartbeat')
         self.Base.create_thread(self.cron, func_args=(self.Base.clean_db_logs, 60 * 60), func_name='clean_db_logs')
 
@@ -0,0 +1,164 @@
+import queue, threading, time
+from itertools import groupby
+from sqlalchemy import Connection
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.sql import text
+from typing import TYPE_CHECKING, Union
+
+if TYPE_CHECKING:
+    from core.base import Base
+
+class DbWriter:
+    '''### Write-behind of the inserts and deletes of the hot path
+    - The statements are queued by Base and written by one thread with its own connection
+    - Group commit: one transaction every FLUSH_ROWS statements or FLUSH_INTERVAL seconds
+    - The consecutive runs of the same statement are sent with executemany
+    - The ids of the logs table are allocated in memory, so the rows referencing them can be queued too
+    '''
+
+    FLUSH_ROWS = 500                                    # Max statements in one transaction
+    FLUSH_INTERVAL = 0.2                                # Max seconds before a queued statement is committed
+
+    def __init__(self, base:'Base') -> None:
+
+        self.Base = base
+        self.queue:queue.Queue[Union[tuple[str, dict], None]] = queue.Queue()
+        self.is_running = False
+        self.stopped = threading.Event()                # Set when run() returns
+        self.write_lock = threading.Lock()              # Only one transaction at a time (worker and flush)
+
+        self.id_lock = threading.Lock()
+        self.last_log_id = self.get_last_id('logs')     # Last id allocated in the logs table
+
+        return None
+
+    def get_last_id(self, table_name:str) -> int:
+        """The last id used by an AUTOINCREMENT table (deleted rows included)
+        for a partitioned table, the last id of all its partitions (table_YYYYMMDD)
+
+        Args:
+            table_name (str): The table name
+
+        Returns:
+            int: The last id, 0 if the table is empty
+        """
+        query = f'''SELECT MAX(last_id) FROM (
+                        SELECT MAX(id) AS last_id FROM {table_name}
+                        UNION ALL
+                        SELECT seq AS last_id FROM sqlite_sequence WHERE name = :table_name OR name GLOB :table_name || '_[0-9]*'
+                    )
+                '''
+        last_id = self.Base.db_execute_query(query, {'table_name': table_name}).scalar()
+
+        return int(last_id) if not last_id is None else 0
+
+    def next_log_id(self) -> int:
+
+        with self.id_lock:
+            self.last_log_id += 1
+            return self.last_log_id
+
+    def write(self, query:str, params:dict) -> None:
+        """Queue a statement
+
+        Args:
+            query (str): The insert / update / delete query
+            params (dict): The parameters of the query
+        """
+        self.queue.put((query, params))
+
+        return None
+
+    def run(self) -> None:
+        """Write the queued statements until stop() is called
+        this method must be run in a thread
+        """
+        self.is_running = True
+        connection = self.Base.engine.connect()         # Created in the writer thread
+
+        while self.is_running:
+            statement = self.queue.get()
+            if statement is None:
+                break
+
+            statements = [statement]
+            deadline = time.monotonic() + self.FLUSH_INTERVAL
+
+            while len(statements) < self.FLUSH_ROWS:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    statement = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if statement is None:
+                    self.is_running = False
+                    break
+                statements.append(statement)
+
+            self.execute(connection, statements)
+
+        connection.close()
+        self.stopped.set()
+
+        return None
+
+    def execute(self, connection:Connection, statements:list[tuple[str, dict]]) -> None:
+        """Write the statements in one transaction
+        if the transaction fails, every statement is written alone so only the bad ones are lost
+
+        Args:
+            connection (Connection): The connection of the calling thread
+            statements (list[tuple[str, dict]]): [(query, params)] in the order they were queued
+        """
+        with self.write_lock:
+            try:
+                for query, same_query_statements in groupby(statements, key=lambda statement: statement[0]):
+                    connection.execute(text(query), [params for _, params in same_query_statements])
+                connection.commit()
+                return None
+            except SQLAlchemyError as error:
+                connection.rollback()
+                self.Base.logs.error(f'{self.__class__.__name__} - {len(statements)} statements - {error}')
+
+            for query, params in statements:
+                try:
+                    connection.execute(text(query), params)
+                    connection.commit()
+                except SQLAlchemyError as error:
+                    connection.rollback()
+                    self.Base.logs.error(f'{self.__class__.__name__} - {query.split()[0]} {params} - {error}')
+
+        return None
+
+    def flush(self) -> None:
+        """Write the pending statements in the calling thread
+        """
+        statements:list[tuple[str, dict]] = []
+
+        while True:
+            try:
+                statement = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if not statement is None:
+                statements.append(statement)
+
+        if statements:
+            with self.Base.engine.connect() as connection:
+                self.execute(connection, statements)
+
+        return None
+
+    def stop(self) -> None:
+        """Stop the writer and write the pending statements
+        """
+        if self.is_running:
+            self.queue.put(None)                        # The writer commits what was queued before, then returns
+            self.stopped.wait(5)
+
+        self.is_running = False
+        self.flush()
+
+        return None
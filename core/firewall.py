@@ -0,0 +1,580 @@
+import json, queue, threading, time
+from abc import ABC, abstractmethod
+from subprocess import run, PIPE
+from typing import TYPE_CHECKING, Union
+
+if TYPE_CHECKING:
+    from core.base import Base
+
+def ip_version(ip:str) -> int:
+    """The ip version of an address or a network (IPv6 addresses always contain ':')
+
+    Args:
+        ip (str): The ip address or the network in CIDR notation
+
+    Returns:
+        int: 4 or 6
+    """
+    return 6 if ':' in ip else 4
+
+class Firewall(ABC):
+    '''### Firewall backend interface
+    Base only talks to the firewall through these methods,
+    the backend is selected with the "firewall" key of configuration.json
+    - setup: create the chain / sets
+    - ban / unban: jail or release an ip address (or a network in CIDR notation), False if the firewall refused it
+    - list_bans: the addresses currently jailed in the firewall
+    - reset: remove everything created by Interceptor
+    kernel_expiry: the kernel releases the bans itself when their timeout expire
+    '''
+
+    name = ''
+    kernel_expiry = False
+
+    def __init__(self, base:'Base', chain_name:str) -> None:
+
+        self.Base = base
+        self.chain_name = chain_name
+
+        return None
+
+    @abstractmethod
+    def setup(self) -> None:
+        pass
+
+    @abstractmethod
+    def ban(self, ip:str, duration_seconds:int) -> bool:
+        pass
+
+    @abstractmethod
+    def unban(self, ip:str) -> bool:
+        pass
+
+    @abstractmethod
+    def list_bans(self) -> list[str]:
+        pass
+
+    @abstractmethod
+    def reset(self) -> None:
+        pass
+
+    def restore(self, operations:list[tuple[str, str, int]]) -> list[tuple[str, str, int]]:
+        """Apply many bans / unbans in firewall transactions
+
+        Args:
+            operations (list[tuple[str, str, int]]): [('ban' | 'unban', ip, duration in seconds)]
+
+        Returns:
+            list[tuple[str, str, int]]: The operations of the transactions that failed, all of them if not supported by the backend
+        """
+        return operations
+
+    def apply(self, operations:list[tuple[str, str, int]]) -> list[str]:
+        """Apply the operations in transactions, one by one the operations of a transaction that failed
+
+        Args:
+            operations (list[tuple[str, str, int]]): [('ban' | 'unban', ip, duration in seconds)]
+
+        Returns:
+            list[str]: The ip whose ban has been refused by the firewall
+        """
+        if len(operations) > 1:
+            operations = self.restore(operations)
+            if not operations:
+                return []
+            self.Base.logs.debug(f'{self.name} - transaction of {len(operations)} operations failed, applied one by one')
+
+        failed_bans:list[str] = []
+
+        for action, ip, duration_seconds in operations:
+            if action == 'ban':
+                if not self.ban(ip, duration_seconds):
+                    failed_bans.append(ip)
+            else:
+                self.unban(ip)
+
+        return failed_bans
+
+    def execute(self, command:list[str], input:Union[str, None] = None, quiet:bool = False) -> bool:
+        """Run a firewall command without shell
+
+        Args:
+            command (list[str]): The command and its arguments
+            input (str, optional): Sent to the standard input of the command. Defaults to None.
+            quiet (bool, optional): The failure is expected (check, already removed), logged in debug. Defaults to False.
+
+        Returns:
+            bool: True if the command succeeded
+        """
+        try:
+            response = run(command, input=None if input is None else input.encode('utf-8'), stdout=PIPE, stderr=PIPE)
+        except OSError as error:
+            self.Base.logs.error(f'{" ".join(command)} - {error}')
+            return False
+
+        if response.returncode != 0:
+            message = f'{" ".join(command)} - {response.stderr.decode("utf-8", errors="replace").strip()}'
+            if quiet:
+                self.Base.logs.debug(message)
+            else:
+                self.Base.logs.error(message)
+
+        return response.returncode == 0
+
+    def output(self, command:list[str]) -> str:
+        """Run a firewall command without shell and return its output
+
+        Args:
+            command (list[str]): The command and its arguments
+
+        Returns:
+            str: The standard output ('' if the command is not available)
+        """
+        try:
+            return run(command, capture_output=True, text=True).stdout or ''
+        except OSError as error:
+            self.Base.logs.error(f'{" ".join(command)} - {error}')
+            return ''
+
+class IptablesFirewall(Firewall):
+    '''### One REJECT rule by jailed address in the INTERCEPTOR chain
+    IPv4 addresses go to iptables, IPv6 addresses to ip6tables
+    '''
+
+    name = 'iptables'
+    IPTABLES = {4: '/sbin/iptables', 6: '/sbin/ip6tables'}
+    IPTABLES_RESTORE = {4: '/sbin/iptables-restore', 6: '/sbin/ip6tables-restore'}
+    HOST_PREFIX = {4: '/32', 6: '/128'}
+
+    def setup(self) -> None:
+        """Create the chain for Interceptor and jump to it from INPUT (iptables and ip6tables)
+        """
+        chain_name = self.chain_name
+
+        for version, iptables in self.IPTABLES.items():
+            self.remove_existing_rules(version)
+
+            # If chain_name equal to INPUT then do not create chain
+            if chain_name == 'INPUT':
+                self.Base.logs.debug(f"Default chain [INPUT]")
+                continue
+
+            # Create the chain (already created if the bans were kept on shutdown)
+            self.execute([iptables, '-N', chain_name], quiet=True)
+            self.Base.logs.debug(f"Creating chain: [{chain_name}] ({iptables})")
+
+            self.execute([iptables, '-A', 'INPUT', '-j', chain_name])
+            self.Base.logs.debug(f"Adding the chain [{chain_name}] to INPUT ({iptables})")
+
+        self.Base.logs.debug(f"Iptables chain [{chain_name}] created.")
+
+        return None
+
+    def count_interceptor_occurence(self, version:int) -> int:
+
+        output = self.output([self.IPTABLES[version], '-S']).splitlines()
+        number_of_occurence:list = []
+
+        for int_occurence in output:
+            if f'-A INPUT -j {self.chain_name}' in int_occurence:
+                number_of_occurence.append(int_occurence)
+
+        return len(number_of_occurence)
+
+    def remove_existing_rules(self, version:int) -> None:
+        """Remove every jump from INPUT to the chain
+
+        Args:
+            version (int): The ip version (4: iptables, 6: ip6tables)
+        """
+        number_of_occurence = self.count_interceptor_occurence(version)
+
+        for i in range(0, number_of_occurence):
+            self.execute([self.IPTABLES[version], '-D', 'INPUT', '-j', self.chain_name])
+
+        return None
+
+    def ban(self, ip:str, duration_seconds:int) -> bool:
+
+        rule = [self.chain_name, '-s', ip, '-j', 'REJECT']
+
+        # Already jailed: a second rule would survive the unban
+        if self.execute([self.IPTABLES[ip_version(ip)], '-C'] + rule, quiet=True):
+            return True
+
+        return self.execute([self.IPTABLES[ip_version(ip)], '-A'] + rule)
+
+    def unban(self, ip:str) -> bool:
+
+        return self.execute([self.IPTABLES[ip_version(ip)], '-D', self.chain_name, '-s', ip, '-j', 'REJECT'])
+
+    def list_bans(self) -> list[str]:
+
+        bans:list[str] = []
+
+        for version, iptables in self.IPTABLES.items():
+            for rule in self.output([iptables, '-S', self.chain_name]).splitlines():
+                # -A INTERCEPTOR -s 1.2.3.4/32 -j REJECT
+                rule_parts = rule.split()
+                if len(rule_parts) < 4 or rule_parts[0] != '-A' or rule_parts[2] != '-s':
+                    continue
+                bans.append(rule_parts[3].removesuffix(self.HOST_PREFIX[version]))
+
+        return bans
+
+    def restore(self, operations:list[tuple[str, str, int]]) -> list[tuple[str, str, int]]:
+
+        version_operations:dict[int, list[tuple[str, str, int]]] = {4: [], 6: []}
+        for operation in operations:
+            version_operations[ip_version(operation[1])].append(operation)
+
+        failed_operations:list[tuple[str, str, int]] = []
+
+        # One transaction by family: only the operations of the family that failed are replayed (-A is not idempotent)
+        for version, operations_of_version in version_operations.items():
+            if not operations_of_version:
+                continue
+            rules = [f"{'-A' if action == 'ban' else '-D'} {self.chain_name} -s {ip} -j REJECT" for action, ip, duration_seconds in operations_of_version]
+            restore_input = '\n'.join(['*filter'] + rules + ['COMMIT']) + '\n'
+            if not self.execute([self.IPTABLES_RESTORE[version], '--noflush'], input=restore_input, quiet=True):
+                failed_operations.extend(operations_of_version)
+
+        return failed_operations
+
+    def reset(self) -> None:
+
+        chain_name = self.chain_name
+
+        for version, iptables in self.IPTABLES.items():
+            # clean ip in the chain
+            self.execute([iptables, '-F', chain_name])
+            self.Base.logs.info(f"Removing IPs from chain: [{chain_name}] ({iptables})")
+
+            # Delete existing rules
+            self.remove_existing_rules(version)
+            self.Base.logs.info(f"Removing rules from INPUT: [{chain_name}] ({iptables})")
+
+            # Remove chain
+            self.execute([iptables, '-X', chain_name])
+            self.Base.logs.info(f"Removing chain: [{chain_name}] ({iptables})")
+
+        return None
+
+class IpsetFirewall(IptablesFirewall):
+    '''### Jailed addresses stored in ipset sets
+    - INTERCEPTOR (hash:ip) for the addresses, INTERCEPTOR-net (hash:net) for the networks
+    - INTERCEPTOR6 and INTERCEPTOR6-net (family inet6) matched by ip6tables
+    - One REJECT rule by set in the INTERCEPTOR chain, O(1) lookup by packet
+    '''
+
+    name = 'ipset'
+    IPSET = '/sbin/ipset'
+    FAMILIES = {4: 'inet', 6: 'inet6'}
+
+    def __init__(self, base:'Base', chain_name:str) -> None:
+
+        super().__init__(base, chain_name)
+        self.sets:dict[int, tuple[str, str]] = {        # {ip version: (set of the addresses, set of the networks)}
+            4: (chain_name, f'{chain_name}-net'),
+            6: (f'{chain_name}6', f'{chain_name}6-net')
+        }
+
+        return None
+
+    def get_set(self, ip:str) -> str:
+
+        set_ip, set_net = self.sets[ip_version(ip)]
+
+        return set_net if '/' in ip else set_ip
+
+    def setup(self) -> None:
+
+        super().setup()
+
+        for version, (set_ip, set_net) in self.sets.items():
+            for set_name, set_type in ((set_ip, 'hash:ip'), (set_net, 'hash:net')):
+                self.execute([self.IPSET, 'create', set_name, set_type, 'family', self.FAMILIES[version], '-exist'])
+
+                match_set = ['-m', 'set', '--match-set', set_name, 'src', '-j', 'REJECT']
+                if not self.execute([self.IPTABLES[version], '-C', self.chain_name] + match_set, quiet=True):
+                    self.execute([self.IPTABLES[version], '-A', self.chain_name] + match_set)
+
+            self.Base.logs.debug(f"Ipset [{set_ip}] and [{set_net}] created.")
+
+        return None
+
+    def ban(self, ip:str, duration_seconds:int) -> bool:
+
+        # Fails when the set is full (maxelem)
+        return self.execute([self.IPSET, 'add', self.get_set(ip), ip, '-exist'])
+
+    def unban(self, ip:str) -> bool:
+
+        return self.execute([self.IPSET, 'del', self.get_set(ip), ip, '-exist'])
+
+    def list_bans(self) -> list[str]:
+
+        bans:list[str] = []
+
+        for set_names in self.sets.values():
+            for set_name in set_names:
+                for line in self.output([self.IPSET, 'save', set_name]).splitlines():
+                    # add INTERCEPTOR 1.2.3.4
+                    line_parts = line.split()
+                    if len(line_parts) >= 3 and line_parts[0] == 'add':
+                        bans.append(line_parts[2])
+
+        return bans
+
+    def restore(self, operations:list[tuple[str, str, int]]) -> list[tuple[str, str, int]]:
+
+        commands = [f"{'add' if action == 'ban' else 'del'} {self.get_set(ip)} {ip}" for action, ip, duration_seconds in operations]
+
+        # add / del -exist are idempotent: the commands applied before a failure can be replayed
+        if self.execute([self.IPSET, '-exist', 'restore'], input='\n'.join(commands) + '\n', quiet=True):
+            return []
+
+        return operations
+
+    def reset(self) -> None:
+
+        super().reset()
+
+        # The sets can be destroyed only when no rule uses them anymore
+        for set_names in self.sets.values():
+            for set_name in set_names:
+                self.execute([self.IPSET, 'destroy', set_name])
+            self.Base.logs.info(f"Removing ipset: [{set_names[0]}] [{set_names[1]}]")
+
+        return None
+
+class NftablesFirewall(Firewall):
+    '''### Jailed addresses stored in nftables sets with timeout
+    - Table inet interceptor, one set by family (flags interval, timeout) matched by one rule
+    - Every element is added with the jail duration as timeout, the kernel expires the bans itself
+    '''
+
+    name = 'nftables'
+    kernel_expiry = True
+    NFT = '/usr/sbin/nft'
+
+    def __init__(self, base:'Base', chain_name:str) -> None:
+
+        super().__init__(base, chain_name)
+        self.table = chain_name.lower()
+        self.sets:dict[int, str] = {4: chain_name, 6: f'{chain_name}6'}     # {ip version: set name}
+
+        return None
+
+    def setup(self) -> None:
+        """Create the table, the sets and the input chain (the existing elements are kept)
+        """
+        table = f'inet {self.table}'
+
+        ruleset = (
+            f'add table {table}\n'
+            f'add set {table} {self.sets[4]} {{ type ipv4_addr; flags interval, timeout; }}\n'
+            f'add set {table} {self.sets[6]} {{ type ipv6_addr; flags interval, timeout; }}\n'
+            f'add chain {table} input {{ type filter hook input priority filter; policy accept; }}\n'
+            f'flush chain {table} input\n'
+            f'add rule {table} input ip saddr @{self.sets[4]} reject\n'
+            f'add rule {table} input ip6 saddr @{self.sets[6]} reject\n'
+        )
+
+        if self.execute([self.NFT, '-f', '-'], input=ruleset):
+            self.Base.logs.debug(f"nftables table [{self.table}] and sets [{self.sets[4]}] [{self.sets[6]}] created.")
+        else:
+            self.Base.logs.critical(f"Unable to create the nftables table [{self.table}]")
+
+        return None
+
+    def get_element(self, action:str, ip:str, duration_seconds:int) -> str:
+
+        if action == 'ban':
+            return f'add element inet {self.table} {self.sets[ip_version(ip)]} {{ {ip} timeout {max(int(duration_seconds), 1)}s }}'
+
+        return f'delete element inet {self.table} {self.sets[ip_version(ip)]} {{ {ip} }}'
+
+    def ban(self, ip:str, duration_seconds:int) -> bool:
+
+        # Fails when the element overlaps an element of the set (flags interval)
+        return self.execute([self.NFT, self.get_element('ban', ip, duration_seconds)])
+
+    def unban(self, ip:str) -> bool:
+
+        # Fails if the kernel already expired the element, nothing to do then
+        return self.execute([self.NFT, self.get_element('unban', ip, 0)], quiet=True)
+
+    def list_bans(self) -> list[str]:
+
+        bans:list[str] = []
+
+        for set_name in self.sets.values():
+            output = self.output([self.NFT, '-j', 'list', 'set', 'inet', self.table, set_name])
+
+            try:
+                nft_objects = json.loads(output).get('nftables', []) if output else []
+            except json.decoder.JSONDecodeError as error:
+                self.Base.logs.error(f'{self.list_bans.__name__} - {error}')
+                continue
+
+            for nft_object in nft_objects:
+                for element in nft_object.get('set', {}).get('elem', []):
+                    # "1.2.3.4" | {"elem": {"val": "1.2.3.4", "timeout": 120, "expires": 98}} | {"prefix": {"addr": "10.0.0.0", "len": 24}}
+                    if isinstance(element, dict) and 'elem' in element:
+                        element = element['elem']['val']
+                    if isinstance(element, dict) and 'prefix' in element:
+                        element = f"{element['prefix']['addr']}/{element['prefix']['len']}"
+                    if isinstance(element, str):
+                        bans.append(element)
+
+        return bans
+
+    def restore(self, operations:list[tuple[str, str, int]]) -> list[tuple[str, str, int]]:
+
+        commands = [self.get_element(action, ip, duration_seconds) for action, ip, duration_seconds in operations]
+
+        # nft -f is atomic: an element already expired by the kernel fails the batch, apply() retries one by one
+        if self.execute([self.NFT, '-f', '-'], input='\n'.join(commands) + '\n', quiet=True):
+            return []
+
+        return operations
+
+    def reset(self) -> None:
+
+        self.execute([self.NFT, 'delete', 'table', 'inet', self.table])
+        self.Base.logs.info(f"Removing nftables table: [{self.table}]")
+
+        return None
+
+class FirewallWorker:
+    '''### Apply the bans / unbans in batches
+    The operations received during BATCH_WINDOW seconds are applied in one transaction
+    (iptables-restore --noflush, ipset restore, nft -f) instead of one fork by operation.
+    '''
+
+    BATCH_WINDOW = 0.05                                 # Seconds to gather the operations
+    MAX_BATCH_SIZE = 1000                               # Max operations in one transaction
+
+    def __init__(self, base:'Base', firewall:Firewall) -> None:
+
+        self.Base = base
+        self.Firewall = firewall
+        self.queue:queue.Queue[Union[tuple[str, str, int], None]] = queue.Queue()
+        self.is_running = False
+        self.stopped = threading.Event()                # Set when run() returns
+        self.apply_lock = threading.Lock()              # Only one transaction at a time (worker and flush)
+
+        return None
+
+    def ban(self, ip:str, duration_seconds:int) -> None:
+
+        self.queue.put(('ban', ip, duration_seconds))
+        return None
+
+    def unban(self, ip:str) -> None:
+
+        self.queue.put(('unban', ip, 0))
+        return None
+
+    def run(self) -> None:
+        """Apply the queued operations until stop() is called
+        this method must be run in a thread
+        """
+        self.is_running = True
+
+        while self.is_running:
+            operation = self.queue.get()
+            if operation is None:
+                break
+
+            operations = [operation]
+            deadline = time.monotonic() + self.BATCH_WINDOW
+
+            while len(operations) < self.MAX_BATCH_SIZE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    operation = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if operation is None:
+                    self.is_running = False
+                    break
+                operations.append(operation)
+
+            self.apply(operations)
+
+        self.stopped.set()
+
+        return None
+
+    def apply(self, operations:list[tuple[str, str, int]]) -> None:
+
+        with self.apply_lock:
+            failed_bans = self.Firewall.apply(operations)
+
+        self.Base.logs.debug(f'{self.Firewall.name} - {len(operations)} operation(s) applied')
+
+        # The registry must not answer "jailed" for an ip the firewall doesn't block
+        for ip in failed_bans:
+            self.Base.ip_tables_ban_failed(ip)
+
+        return None
+
+    def flush(self) -> None:
+        """Apply the pending operations in the calling thread
+        """
+        operations:list[tuple[str, str, int]] = []
+
+        while True:
+            try:
+                operation = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if not operation is None:
+                operations.append(operation)
+
+        if operations:
+            self.apply(operations)
+
+        return None
+
+    def stop(self) -> None:
+        """Stop the worker and apply the pending operations
+        """
+        if self.is_running:
+            self.queue.put(None)                        # The worker applies what was queued before, then returns
+            self.stopped.wait(5)
+
+        self.is_running = False
+        self.flush()
+
+        return None
+
+FIREWALLS:dict[str, type[Firewall]] = {
+    IptablesFirewall.name: IptablesFirewall,
+    IpsetFirewall.name: IpsetFirewall,
+    NftablesFirewall.name: NftablesFirewall
+}
+
+def create_firewall(base:'Base', chain_name:str) -> Firewall:
+    """Create the firewall backend selected in configuration.json
+
+    Args:
+        base (Base): The Base instance
+        chain_name (str): The iptables chain name
+
+    Returns:
+        Firewall: The firewall backend (iptables if the name is unknown)
+    """
+    name = base.getAppConfig('firewall') or IptablesFirewall.name
+
+    if not name in FIREWALLS:
+        base.logs.critical(f'Unknown firewall backend "{name}", available: {list(FIREWALLS)} - using iptables')
+        name = IptablesFirewall.name
+
+    base.logs.debug(f'Firewall backend: {name}')
+
+    return FIREWALLS[name](base, chain_name)
@@ -0,0 +1,367 @@
+import os, glob, json, time, select, struct, ctypes, ctypes.util
+from fnmatch import fnmatch
+from typing import Union
+from core import base, parser, intercept
+from core.rules import ModuleRules, compile_source
+
+class FollowedFile:
+    '''### A log file followed by the LogFollower
+    '''
+
+    def __init__(self, path:str, file_object, inode:int, offset:int) -> None:
+
+        self.path = path                                # Full path of the file
+        self.file_object = file_object                  # Raw file object opened in binary mode
+        self.inode = inode                              # Inode of the opened file (rename rotation detection)
+        self.offset = offset                            # Position of the last complete line analysed
+        self.pending = b''                              # Incomplete last line
+        self.Intercept:Union[intercept.Intercept, None] = None
+
+        return None
+
+class LogFollower:
+    '''### Follow many log files in one thread
+    - One inotify instance watching the directories of the sources (polling if inotify is not available)
+    - Glob patterns as source_log (/var/log/nginx/*.log)
+    - Logrotate support (rename and copytruncate)
+    - Byte offsets saved in db/follower_offsets.json to resume after a restart
+    '''
+
+    READ_BUFFER_SIZE = 64 * 1024                        # Max bytes read from a file in one call
+    POLL_INTERVAL = 1                                   # Seconds between two full checks of the files (polling)
+    SAFETY_CHECK_INTERVAL = 60                          # Seconds between two full checks of the files with inotify
+    SAVE_INTERVAL = 10                                  # Seconds between two saves of the offsets
+
+    IN_MODIFY       = 0x00000002
+    IN_ATTRIB       = 0x00000004
+    IN_CLOSE_WRITE  = 0x00000008
+    IN_MOVED_FROM   = 0x00000040
+    IN_MOVED_TO     = 0x00000080
+    IN_CREATE       = 0x00000100
+    IN_DELETE       = 0x00000200
+    IN_Q_OVERFLOW   = 0x00004000
+    IN_IGNORED      = 0x00008000
+    IN_EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self, base:base.Base, parser:parser.Parser, sources:dict[str, list[ModuleRules]]) -> None:
+
+        self.Base = base
+        self.Parser = parser
+        self.sources = sources                          # {source_log (path or glob pattern): [modules]}
+
+        self.offsets_file = f'db{os.sep}follower_offsets.json'
+        self.saved_offsets:dict[str, dict] = self.load_offsets()
+
+        self.files:dict[str, FollowedFile] = {}         # {path: followed file}
+        self.watches:dict[int, str] = {}                # {inotify watch descriptor: directory}
+        self.inotify_fd:Union[int, None] = self.init_inotify()
+        self.is_running = True
+        self.last_save = time.time()
+
+        self.watch_directories(startup=True)
+        self.discover_files(startup=True)
+
+        return None
+
+    def init_inotify(self) -> Union[int, None]:
+        """Create the inotify instance
+
+        Returns:
+            int | None: The inotify file descriptor or None if inotify is not available (polling)
+        """
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            inotify_fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError) as error:
+            self.Base.logs.warning(f'inotify not available, polling every {self.POLL_INTERVAL}s - {error}')
+            return None
+
+        if inotify_fd < 0:
+            self.Base.logs.warning(f'inotify_init1 failed (errno {ctypes.get_errno()}), polling every {self.POLL_INTERVAL}s')
+            return None
+
+        return inotify_fd
+
+    def watch_directories(self, startup:bool = False) -> None:
+        """Watch the directories of the sources, a glob in the directory (/var/log/*/access.log)
+        is expanded to the existing directories, called again by the full checks for the new ones
+
+        Args:
+            startup (bool, optional): True on the first call, the missing directories are reported. Defaults to False.
+        """
+        if self.inotify_fd is None:
+            return None
+
+        watched_directories = set(self.watches.values())
+
+        for pattern in {os.path.dirname(source) for source in self.sources}:
+            if not any(character in pattern for character in '*?['):
+                directories = [pattern] if os.path.isdir(pattern) else []
+            else:
+                directories = [directory for directory in glob.glob(pattern) if os.path.isdir(directory)]
+
+            if not directories and startup:
+                self.Base.logs.critical(f'{self.__class__.__name__} - {pattern} - no such directory')
+
+            for directory in directories:
+                if not directory in watched_directories:
+                    self.add_watch(directory)
+                    watched_directories.add(directory)
+
+        return None
+
+    def add_watch(self, directory:str) -> None:
+
+        if self.inotify_fd is None:
+            return None
+
+        mask = (self.IN_MODIFY | self.IN_ATTRIB | self.IN_CLOSE_WRITE | self.IN_MOVED_FROM
+                | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE)
+        watch_descriptor = self.libc.inotify_add_watch(self.inotify_fd, os.fsencode(directory), mask)
+
+        if watch_descriptor < 0:
+            self.Base.logs.error(f'inotify_add_watch {directory} failed (errno {ctypes.get_errno()})')
+            return None
+
+        self.watches[watch_descriptor] = directory
+
+        return None
+
+    def get_modules(self, path:str) -> list[ModuleRules]:
+        """Every module whose source_log (path or glob) matches the file
+
+        Args:
+            path (str): The file path
+
+        Returns:
+            list[ModuleRules]: The modules attached to the file
+        """
+        modules:list[ModuleRules] = []
+        for source, source_modules in self.sources.items():
+            if path == source or fnmatch(path, source):
+                modules.extend(source_modules)
+
+        return modules
+
+    def discover_files(self, startup:bool = False) -> None:
+        """Open the files matching the sources that are not followed yet
+
+        Args:
+            startup (bool, optional): True on the first call, unknown files are read from their end. Defaults to False.
+        """
+        for source in self.sources:
+            for path in glob.glob(source):
+                if path in self.files or not os.path.isfile(path):
+                    continue
+                self.open_file(path, from_end=startup)
+
+        return None
+
+    def open_file(self, path:str, from_end:bool) -> None:
+        """Start following a file
+
+        Args:
+            path (str): The file path
+            from_end (bool): Start from the end of the file if no saved offset is available
+        """
+        try:
+            file_object = open(path, 'rb', buffering=0)
+        except OSError as error:
+            self.Base.logs.error(f'{self.open_file.__name__} - {path} - {error}')
+            return None
+
+        stat = os.fstat(file_object.fileno())
+        saved = self.saved_offsets.pop(path, None)
+
+        if not saved is None and saved.get('inode') == stat.st_ino and saved.get('offset', 0) <= stat.st_size:
+            offset = saved['offset']                    # Resume where Interceptor stopped
+        elif not saved is None:
+            offset = 0                                  # The file was rotated while Interceptor was stopped
+        elif from_end:
+            offset = stat.st_size                       # Like tail -n 0
+        else:
+            offset = 0                                  # New file created while running
+
+        file_object.seek(offset)
+
+        followed = FollowedFile(path, file_object, stat.st_ino, offset)
+        followed.Intercept = intercept.Intercept(self.Base, self.Parser, compile_source(path, self.get_modules(path)))
+        self.files[path] = followed
+
+        self.Base.logs.debug(f'Following {path} from offset {offset}')
+
+        return None
+
+    def close_file(self, followed:FollowedFile) -> None:
+
+        self.read_file(followed)
+        followed.file_object.close()
+        del self.files[followed.path]
+
+        return None
+
+    def check_file(self, followed:FollowedFile) -> None:
+        """Read the new lines of a file and detect the rotations
+
+        Args:
+            followed (FollowedFile): The followed file
+        """
+        try:
+            stat = os.stat(followed.path)
+        except FileNotFoundError:
+            stat = None
+
+        # Rename rotation or deletion: finish the old file, the new one is opened from the beginning
+        if stat is None or stat.st_ino != followed.inode:
+            self.close_file(followed)
+            if not stat is None:
+                self.open_file(followed.path, from_end=False)
+                if followed.path in self.files:
+                    self.read_file(self.files[followed.path])
+            return None
+
+        # Copytruncate rotation
+        if stat.st_size < followed.offset:
+            self.Base.logs.debug(f'{followed.path} truncated, reading from the beginning')
+            followed.file_object.seek(0)
+            followed.offset = 0
+            followed.pending = b''
+
+        self.read_file(followed)
+
+        return None
+
+    def read_file(self, followed:FollowedFile) -> None:
+        """Read and analyse everything available in the file
+
+        Args:
+            followed (FollowedFile): The followed file
+        """
+        while True:
+            chunk = followed.file_object.read(self.READ_BUFFER_SIZE)
+            if not chunk:
+                break
+
+            lines = chunk.split(b'\n')
+            lines[0] = followed.pending + lines[0]
+            followed.pending = lines.pop()          # The last line is not complete yet
+            followed.offset += len(chunk)
+
+            for line in lines:
+                followed.Intercept.run_raw(line)
+
+        return None
+
+    def read_events(self) -> set[str]:
+        """Read the pending inotify events
+
+        Returns:
+            set[str]: The paths concerned by the events, '*' if the event queue overflowed
+        """
+        paths:set[str] = set()
+
+        try:
+            buffer = os.read(self.inotify_fd, self.READ_BUFFER_SIZE)
+        except BlockingIOError:
+            return paths
+
+        position = 0
+        while position + self.IN_EVENT_HEADER.size <= len(buffer):
+            watch_descriptor, mask, cookie, name_length = self.IN_EVENT_HEADER.unpack_from(buffer, position)
+            position += self.IN_EVENT_HEADER.size
+            name = buffer[position:position + name_length].rstrip(b'\0')
+            position += name_length
+
+            if mask & self.IN_Q_OVERFLOW:
+                paths.add('*')
+            elif mask & self.IN_IGNORED:
+                # The directory was removed, watched again by a full check if it comes back
+                self.watches.pop(watch_descriptor, None)
+            elif watch_descriptor in self.watches and name:
+                paths.add(os.path.join(self.watches[watch_descriptor], os.fsdecode(name)))
+
+        return paths
+
+    def run(self) -> None:
+        """Follow the files until stop() is called
+        this method must be run in a thread
+        """
+        poller = None
+        if not self.inotify_fd is None:
+            poller = select.epoll()
+            poller.register(self.inotify_fd, select.EPOLLIN)
+
+        last_full_check = time.time()
+        # With inotify the events tell which files changed, the full check is only a safety net (and IN_Q_OVERFLOW)
+        full_check_interval = self.POLL_INTERVAL if poller is None else self.SAFETY_CHECK_INTERVAL
+
+        while self.is_running:
+            paths:set[str] = set()
+
+            if poller is None:
+                time.sleep(self.POLL_INTERVAL)
+            elif poller.poll(self.POLL_INTERVAL):
+                paths = self.read_events()
+
+            now = time.time()
+            full_check = '*' in paths or now - last_full_check >= full_check_interval
+
+            if full_check:
+                last_full_check = now
+                self.watch_directories()
+                self.discover_files()
+                paths = set(self.files)
+            elif any(not path in self.files and self.get_modules(path) for path in paths):
+                self.discover_files()
+
+            for path in paths:
+                followed = self.files.get(path)
+                if not followed is None:
+                    self.check_file(followed)
+
+            if now - self.last_save >= self.SAVE_INTERVAL:
+                self.save_offsets()
+
+        if not poller is None:
+            poller.close()
+
+        return None
+
+    def stop(self) -> None:
+        """Stop following the files and save the offsets
+        """
+        self.is_running = False
+        self.save_offsets()
+
+        return None
+
+    def load_offsets(self) -> dict[str, dict]:
+
+        if not os.path.exists(self.offsets_file):
+            return {}
+
+        try:
+            with open(self.offsets_file, 'r') as offsets:
+                return json.load(offsets)
+        except (OSError, json.decoder.JSONDecodeError) as error:
+            self.Base.logs.error(f'{self.load_offsets.__name__} - {self.offsets_file} - {error}')
+            return {}
+
+    def save_offsets(self) -> None:
+        """Save the offset of the last complete line of every file
+        """
+        self.last_save = time.time()
+        offsets = {
+            path: {'inode': followed.inode, 'offset': followed.offset - len(followed.pending)}
+            for path, followed in list(self.files.items())
+        }
+
+        temporary_file = f'{self.offsets_file}.tmp'
+        try:
+            with open(temporary_file, 'w') as file:
+                json.dump(offsets, file)
+            os.replace(temporary_file, self.offsets_file)
+        except OSError as error:
+            self.Base.logs.error(f'{self.save_offsets.__name__} - {self.offsets_file} - {error}')
+
+        return None
@@ -1,148 +1,384 @@
-import re
+import re, ipaddress, time
+from datetime import datetime
 from core import base, parser
-from subprocess import Popen
+from core.rules import ModuleRules, SourceRules, field_name
 from typing import Union
 
 class Intercept:
 
-    __PATTERN_IPV4 = r'(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}).*$'
-    __PATTERN_IPV6 = r'([0-9a-fA-F]{1,4}(?::[0-9a-fA-F]{1,4}){7})'
+    __PATTERN_IPV4 = re.compile(r'(?<![\d.])(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})(?!\.?\d)')
+    __PATTERN_IPV6 = re.compile(r'(?<![\w:])((?:[0-9a-fA-F]{0,4}:){2,7}[0-9a-fA-F]{0,4})(?![\w:])')     # Candidates, validated by normalize_ip
+    __PATTERNS_USER = (
+        re.compile(r'.*user=(\w*)'),
+        re.compile(r'^.*Invalid user\s(\D*?)\s.*$'),
+        re.compile(r'^.*\b(\w+)\s+from.*$')
+    )
+    __FIELDS = ('ip', 'user', 'service_id')      # Named groups a filter can capture
+    __PATTERN_SYSLOG_TIME = re.compile(r'^(?P<month>[A-Z][a-z]{2}) +(?P<day>\d{1,2}) (?P<time>\d{2}:\d{2}:\d{2})\b')
+    __PATTERN_ISO_TIME = re.compile(r'^(?P<date>\d{4}-\d{2}-\d{2})[T ](?P<time>\d{2}:\d{2}:\d{2})(?:[.,]\d+)?(?:(?P<utc>Z)|(?P<offset_hours>[+-]\d{2}):?(?P<offset_minutes>\d{2}))?')
+    __MONTHS = {month: position for position, month in enumerate(('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'), 1)}
 
-    def __init__(self, base: base.Base, parser: parser.Parser, subprocess:Popen, subprocess_detail:dict) -> None:
+    def __init__(self, base: base.Base, parser: parser.Parser, source_rules:SourceRules) -> None:
 
         self.Base                       = base                              # Création d'une instance Base()
         self.Parser                     = parser                            # Création d'une instance Parser()
-        self.subprocess                 = subprocess                        # Get the source of the log
-        self.subprocess_detail          = subprocess_detail
+        self.source_rules               = source_rules                      # The modules attached to the log source
         self.global_sys_attempt         = self.Base.default_attempt         # Number of attempt for the jail
         self.global_sys_jail_duration   = self.Base.default_jail_duration   # Duration in seconds before the release
+        self.global_sys_find_window     = self.Base.default_find_window     # Window in seconds where the attempts are counted
         self.default_ip                 = self.Base.default_ipv4            # Default ipv4 to be used by Interceptor
 
-        self.Base.clean_iptables()                                          # Premiere initialisation vider les ban dans la base de données
+        return None
+
+    def run_raw(self, line:bytes) -> None:
+        """Analyse a raw line read from the log source.
+        The line is decoded only if it passes the keywords prefilter
+
+        Args:
+            line (bytes): The raw line without the line feed
+        """
+        prefilter = self.source_rules.prefilter
+
+        # Most of the lines are not related to any module
+        if not prefilter is None and not prefilter.is_candidate(line):
+            return None
+
+        output = line.decode('utf-8', errors='replace').strip()
+        if output:
+            self.run_process(output)
 
         return None
 
-    def run_process(self, output:str) -> None:
+    def run_entry(self, output:str, fields:dict) -> None:
+        """Analyse a structured journal entry.
+        A module with journal_match is selected by the fields and uses _PID as service id,
+        the others are selected by their rgx_service_name
 
-        for mod_name in self.Parser.module_names:
-            if self.subprocess_detail[mod_name] == self.subprocess:
-                service = re.search(self.Parser.modules[mod_name]['rgx_service_name'], output)
+        Args:
+            output (str): The text line rebuilt from the entry ("host ident[pid]: message")
+            fields (dict): The fields of the journal entry
+        """
+        # __REALTIME_TIMESTAMP: microseconds, the entries replayed after a restart keep their time
+        realtime = self.Base.convert_to_integer(fields.get('__REALTIME_TIMESTAMP'))
+        event_time = realtime // 1000000 if type(realtime) == int and realtime > 0 else self.Base.get_unixtime()
+
+        for rules in self.source_rules.journal_modules:
+            for field, values in rules.journal_match.items():
+                if not fields.get(field) in values:
+                    break
+            else:
+                self.record_entry(output, rules, fields.get('_PID'), event_time)
 
-                if service:
-                    self.record_entry(output, mod_name)
+        # The other modules: the same combined service matcher as the log files
+        if len(self.source_rules.journal_modules) < len(self.source_rules.modules):
+            self.run_process(output, event_time)
 
         return None
 
-    def record_entry(self, output:str, mod_name:str) -> None:
+    def run_process(self, output:str, event_time:Union[int, None] = None) -> None:
+        """Analyse a text line with the modules selected by their service name
+        the journal_match modules are excluded, run_entry selects them by the fields
 
-        ip = ''
-        ip_exceptions:list = []
-        ipv4_address = self.get_ipv4_address(output, mod_name)
-        ipv6_address = self.get_ipv6_address(output, mod_name)
-        if not ipv4_address is None:
-            ip = ipv4_address
-        elif not ipv6_address is None:
-            ip = ipv6_address
-        else:
-            ip = self.default_ip
-
-        user = self.get_users_attempt(output, mod_name)
-        service_id = self.get_service_id(output, mod_name)
-        modules:dict[any, dict] = self.Parser.modules
-
-        # Charger les exceptions du process en cours
-        for key, exception in modules[mod_name].items():
-            if type(exception) == list and key == 'ip_exceptions':
-                for ip_exception in exception:
-                    ip_exceptions.append(ip_exception)
-
-        # Charger les filtres du process en cours
-        for key, filters in modules[mod_name].items():
-            if self.subprocess_detail[mod_name] == self.subprocess:
-                if type(filters) == dict and key == 'filters':
-                    for filter_name, filter_value in filters.items():
-                        lookup = re.search(filter_value, output)
-                        if lookup:
-                            
-                            # Si l'ip est dans liste d'exception globale
-                            if ip in self.Base.global_whitelisted_ip:
-                                self.Base.logs.info(f'Global exception - [{ip}] was exempted from the analysis ...')
-
-                            # Si l'ip est dans la liste de l'exception du module
-                            elif ip in ip_exceptions:
-                                self.Base.logs.info(f'Module "{mod_name}" exception - [{ip}] was exempted from the analysis ...')
-
-                            else:
-                                # Get Information from HQ and Report to HQ
-                                ab_score, hq_totalReports = self.Base.get_internal_hq_info(ip)
-
-                                if self.Base.db_record_ip(service_id, output, mod_name, ip, filter_name, user):
-
-                                    if not ab_score is None or not hq_totalReports is None:
-                                        ab_score = ab_score if not ab_score is None else 0
-                                        hq_totalReports = hq_totalReports if not hq_totalReports is None else 0
-
-                                        if ab_score >= self.Base.default_intcHQ_jail_abuseipdb_score:
-                                            if self.Base.ip_tables_add(mod_name, ip, self.Base.default_intcHQ_jail_duration) > 0:
-                                                self.Base.logs.info(f'{mod_name} - HQ - "{ip}" - Jailed for {str(self.Base.default_intcHQ_jail_duration)} seconds | Reports: {str(hq_totalReports)} / Score: {str(ab_score)}')
-                                        elif hq_totalReports >= self.Base.default_intcHQ_jail_totalReports:
-                                            if self.Base.ip_tables_add(mod_name, ip, self.Base.default_intcHQ_jail_duration) > 0:
-                                                self.Base.logs.info(f'{mod_name} - HQ - "{ip}" - Jailed for {str(self.Base.default_intcHQ_jail_duration)} seconds | HQ_Reports: {str(hq_totalReports)} / ab_Score {str(ab_score)}')
-                                        else:
-                                            self.execute_action(ip, mod_name)
-                                    else:
-                                        self.execute_action(ip, mod_name)
+        Args:
+            output (str): The log line
+            event_time (Union[int, None], optional): Unixtime of the event, read in the line if None. Defaults to None.
+        """
+        source_rules = self.source_rules
+        modules = source_rules.modules
+
+        if source_rules.service_matcher is None:
+            for rules in modules:
+                if not rules.journal_match and rules.service_name.search(output):
+                    self.record_entry(output, rules, event_time=event_time)
+            return None
+
+        # One scan of the line to know if at least one module is concerned
+        service = source_rules.service_matcher.search(output)
+        if not service:
+            return None
+
+        first_position = source_rules.service_groups[service.lastgroup]
+        self.record_entry(output, modules[first_position], event_time=event_time)
+
+        # Several modules can share the same service name
+        for position, rules in enumerate(modules):
+            if position != first_position and not rules.journal_match and rules.service_name.search(output):
+                self.record_entry(output, rules, event_time=event_time)
+
+        return None
+
+    def record_entry(self, output:str, rules:ModuleRules, service_id_field:str = None, event_time:Union[int, None] = None) -> None:
+
+        mod_name = rules.module_name
+
+        # Nothing is extracted from the line until a filter matched
+        lookup = self.match_filter(output, rules)
+        if lookup is None:
+            return None
+
+        if event_time is None:
+            event_time = self.get_event_time(output)
+
+        filter_name, fields = lookup
+
+        ip = self.normalize_ip(fields.get('ip')) or self.get_ip_address(output, rules)
+        ip_exceptions = rules.ip_exceptions
+
+        # Already jailed: nothing more to do with this line
+        if self.Base.bans.is_banned(ip):
+            return None
+
+        # Si l'ip est dans liste d'exception globale
+        if ip in self.Base.global_whitelist:
+            self.Base.logs.info(f'Global exception - [{ip}] was exempted from the analysis ...')
+            return None
+
+        # Si l'ip est dans la liste de l'exception du module
+        if ip in ip_exceptions:
+            self.Base.logs.info(f'Module "{mod_name}" exception - [{ip}] was exempted from the analysis ...')
+            return None
+
+        user = fields.get('user') or self.get_users_attempt(output, rules)
+        service_id = self.get_service_id(output, rules, fields.get('service_id') or service_id_field)
+
+        # Get Information from HQ and Report to HQ
+        ab_score, hq_totalReports = self.Base.get_internal_hq_info(ip)
+
+        if self.Base.db_record_ip(service_id, output, mod_name, ip, filter_name, user):
+
+            attempt = self.count_attempt(ip, rules, service_id, event_time)
+
+            if not ab_score is None or not hq_totalReports is None:
+                ab_score = ab_score if not ab_score is None else 0
+                hq_totalReports = hq_totalReports if not hq_totalReports is None else 0
+
+                if ab_score >= self.Base.default_intcHQ_jail_abuseipdb_score:
+                    if self.Base.ip_tables_add(mod_name, ip, self.Base.default_intcHQ_jail_duration) > 0:
+                        self.Base.logs.info(f'{mod_name} - HQ - "{ip}" - Jailed for {str(self.Base.default_intcHQ_jail_duration)} seconds | Reports: {str(hq_totalReports)} / Score: {str(ab_score)}')
+                elif hq_totalReports >= self.Base.default_intcHQ_jail_totalReports:
+                    if self.Base.ip_tables_add(mod_name, ip, self.Base.default_intcHQ_jail_duration) > 0:
+                        self.Base.logs.info(f'{mod_name} - HQ - "{ip}" - Jailed for {str(self.Base.default_intcHQ_jail_duration)} seconds | HQ_Reports: {str(hq_totalReports)} / ab_Score {str(ab_score)}')
+                else:
+                    self.execute_action(ip, rules, attempt)
+            else:
+                self.execute_action(ip, rules, attempt)
+
+            # Subnet escalation: the attempts of the whole prefix are counted together
+            if 'prefix_attempt' in rules.actions:
+                network, prefix_attempt = self.count_prefix_attempt(ip, rules, service_id, event_time)
+                if not network is None:
+                    self.execute_prefix_action(network, rules, prefix_attempt)
 
         return None
 
-    def execute_action(self, received_ip:str, mod_name:str) -> None:
+    def match_filter(self, output:str, rules:ModuleRules) -> Union[tuple[str, dict], None]:
+        """Retourne le nom du filtre qui a matché la ligne
+        et les champs capturés par les groupes nommés du filtre (ip, user, service_id)
+
+        Args:
+            output (str): journalctl output
+            rules (ModuleRules): The compiled rules of the module
+
+        Returns:
+            tuple[str, dict] | None: (filter name, {field: value}) or None if no filter matched
+        """
+        if not rules.filters_matcher is None:
+            lookup = rules.filters_matcher.search(output)
+            if lookup:
+                return rules.filters_groups[lookup.lastgroup], self.get_fields(lookup)
+            return None
+
+        for filter_name, filter_pattern in rules.filters:
+            lookup = filter_pattern.search(output)
+            if lookup:
+                return filter_name, self.get_fields(lookup)
+
+        return None
+
+    def get_fields(self, lookup:re.Match) -> dict:
+        """Retourne les champs capturés par les groupes nommés (ip, user, service_id)
+
+        Args:
+            lookup (re.Match): The filter match
+
+        Returns:
+            dict: {field: value} only for the captured fields
+        """
+        if not lookup.re.groupindex:
+            return {}
+
+        # The groups of the combined filters are renamed _g{n}_{field}, only the matched filter has values
+        fields = {field_name(group_name): value for group_name, value in lookup.groupdict().items() if value}
+
+        return {field: value for field, value in fields.items() if field in self.__FIELDS}
+
+    def execute_action(self, received_ip:str, rules:ModuleRules, attempt:int) -> None:
         """Executer un ban au niveau de iptables si les conditions sont réunies
 
+        Args:
+            received_ip (str): The remote ip address
+            rules (ModuleRules): The compiled rules of the module
+            attempt (int): Number of distinct attempts of the ip in the find window
+
         Returns:
             None: aucun retour requis
         """
+        mod_name = rules.module_name
+
+        # so far "actions": {'attempt': 4}
+        actions = rules.actions
+        if 'attempt' in actions:
+            sys_attempt = actions['attempt']
+        else:
+            sys_attempt = self.global_sys_attempt
+
+        if 'jail_duration' in actions:
+            sys_ban_duration = int(actions['jail_duration'])
+        else:
+            sys_ban_duration = self.global_sys_jail_duration
+
+        if attempt >= sys_attempt:
+            if self.Base.ip_tables_add(mod_name, received_ip, sys_ban_duration) > 0:
+                self.Base.logs.info(f'{mod_name} - "{received_ip}" - Moving to jail for {str(sys_ban_duration)} seconds')
+
+        return None
+
+    def count_attempt(self, received_ip:str, rules:ModuleRules, service_id:str, event_time:int) -> int:
+        """Record the attempt in the in-memory sliding window
+
+        Args:
+            received_ip (str): The remote ip address
+            rules (ModuleRules): The compiled rules of the module
+            service_id (str): The service id of the attempt
+            event_time (int): Unixtime of the event (not of the reading, the lines can be replayed)
+
+        Returns:
+            int: Number of distinct attempts of the ip in the find window
+        """
+        find_window = int(rules.actions.get('find_window', self.global_sys_find_window))
+
+        return self.Base.attempts.add(rules.module_name, received_ip, service_id, event_time, find_window, self.Base.get_unixtime())
+
+    def get_event_time(self, output:str) -> int:
+        """Retourne l'heure de l'évènement écrite au début de la ligne
+        syslog "Feb 17 10:00:01" (local time, year guessed) or ISO 8601 "2024-02-17T10:00:01+01:00"
+
+        Args:
+            output (str): The log line
+
+        Returns:
+            int: The unixtime of the event, the current unixtime if the line has no timestamp
+        """
+        now = self.Base.get_unixtime()
+
+        lookup = self.__PATTERN_ISO_TIME.match(output)
+        if lookup:
+            # Rebuilt for python 3.10: fromisoformat refuses "Z", "+0000" and the fractions other than 3 or 6 digits
+            if not lookup.group('utc') is None:
+                offset = '+00:00'
+            elif not lookup.group('offset_hours') is None:
+                offset = f"{lookup.group('offset_hours')}:{lookup.group('offset_minutes')}"
+            else:
+                offset = ''                             # Local time
+            try:
+                return min(int(datetime.fromisoformat(f"{lookup.group('date')}T{lookup.group('time')}{offset}").timestamp()), now)
+            except ValueError:
+                return now
+
+        lookup = self.__PATTERN_SYSLOG_TIME.match(output)
+        if lookup is None or not lookup.group('month') in self.__MONTHS:
+            return now
+
+        year = time.localtime(now).tm_year
         try:
-            # for mod_name in self.Parser.module_names:
-            if self.subprocess_detail[mod_name] == self.subprocess:
-                query = f'''SELECT a.ip_address, count(DISTINCT(a.intrusion_service_id)) as "attempt" 
-                            FROM logs as a 
-                            WHERE a.module_name = :module_name and a.ip_address = :ip
-                            GROUP BY a.ip_address
-                        '''
-                mes_donnees = {'module_name': mod_name, 'ip': received_ip}
-
-                # so far "actions": {'attempt': 4}
-                if 'attempt' in self.Parser.modules[mod_name]['actions']:
-                    sys_attempt = self.Parser.modules[mod_name]['actions']['attempt']
-                else:
-                    sys_attempt = self.global_sys_attempt
+            event = datetime.strptime(f"{year} {self.__MONTHS[lookup.group('month')]} {lookup.group('day')} {lookup.group('time')}", '%Y %m %d %H:%M:%S')
+            # No year in syslog: a date in the future is a line of the last year
+            if event.timestamp() > now + 86400:
+                event = event.replace(year=year - 1)
+        except ValueError:
+            return now
 
-                if 'jail_duration' in self.Parser.modules[mod_name]['actions']:
-                    sys_ban_duration = int(self.Parser.modules[mod_name]['actions']['jail_duration'])
-                else:
-                    sys_ban_duration = self.global_sys_jail_duration
+        return min(int(event.timestamp()), now)
+
+    def get_prefix(self, received_ip:str, rules:ModuleRules) -> Union[str, None]:
+        """Retourne le réseau de l'ip selon prefix_v4 / prefix_v6 du module
 
-                cursorResult = self.Base.db_execute_query(query, mes_donnees)
-                r = cursorResult.fetchall()
+        Args:
+            received_ip (str): The remote ip address
+            rules (ModuleRules): The compiled rules of the module
 
-                for results_ip in r:
-                    db_ip, db_attempt = results_ip
-                    if db_attempt >= sys_attempt:
-                        if self.Base.ip_tables_add(mod_name, db_ip, sys_ban_duration) > 0:
-                            self.Base.logs.info(f'{mod_name} - "{db_ip}" - Moving to jail for {str(sys_ban_duration)} seconds')
-                    
-                    self.Base.clean_iptables()
+        Returns:
+            str | None: The network in CIDR notation (1.2.3.0/24) or None if the ip is not valid
+        """
+        if received_ip == self.default_ip:
+            return None
 
+        try:
+            address = ipaddress.ip_address(received_ip)
+        except ValueError:
             return None
 
-        except KeyError as ke:
-            self.Base.logs.critical(f'keyError {mod_name} - {__name__} - {self.execute_action.__name__}: key {ke} is not available')
+        if address.version == 4:
+            prefix_length = int(rules.actions.get('prefix_v4', 24))
+        else:
+            prefix_length = int(rules.actions.get('prefix_v6', 64))
+
+        return str(ipaddress.ip_network(f'{address}/{prefix_length}', strict=False))
+
+    def count_prefix_attempt(self, received_ip:str, rules:ModuleRules, service_id:str, event_time:int) -> tuple[Union[str, None], int]:
+        """Record the attempt for the network of the ip in the in-memory sliding window
 
-    def get_service_id(self, output:str, mod_name:str) -> str:
+        Args:
+            received_ip (str): The remote ip address
+            rules (ModuleRules): The compiled rules of the module
+            service_id (str): The service id of the attempt
+            event_time (int): Unixtime of the event
+
+        Returns:
+            tuple[str | None, int]: The network and its number of distinct attempts in the find window
+        """
+        network = self.get_prefix(received_ip, rules)
+        if network is None:
+            return None, 0
+
+        find_window = int(rules.actions.get('find_window', self.global_sys_find_window))
+        attempt = self.Base.attempts.add(rules.module_name, network, f'{received_ip} {service_id}', event_time, find_window, self.Base.get_unixtime())
+
+        return network, attempt
+
+    def execute_prefix_action(self, network:str, rules:ModuleRules, prefix_attempt:int) -> None:
+        """Jail the whole network when prefix_attempt is reached
+        the network is never jailed if it contains a whitelisted ip
+
+        Args:
+            network (str): The network in CIDR notation
+            rules (ModuleRules): The compiled rules of the module
+            prefix_attempt (int): Number of distinct attempts of the network in the find window
+        """
+        mod_name = rules.module_name
+        actions = rules.actions
+
+        if prefix_attempt < int(actions['prefix_attempt']) or self.Base.bans.is_banned(network):
+            return None
+
+        if self.Base.global_whitelist.overlaps(network) or rules.ip_exceptions.overlaps(network):
+            self.Base.logs.debug(f'{mod_name} - "{network}" - contains whitelisted ip, not jailed')
+            return None
+
+        sys_ban_duration = int(actions.get('prefix_jail_duration', actions.get('jail_duration', self.global_sys_jail_duration)))
+
+        if self.Base.ip_tables_add_network(mod_name, network, sys_ban_duration) > 0:
+            self.Base.logs.info(f'{mod_name} - "{network}" - {prefix_attempt} attempts from the network, moving to jail for {str(sys_ban_duration)} seconds')
+
+        return None
+
+    def get_service_id(self, output:str, rules:ModuleRules, service_id_field:str = None) -> str:
         """Retourn le process id
 
         Args:
             output (str): journalctl output
+            rules (ModuleRules): The compiled rules of the module
+            service_id_field (str, optional): The service id captured by the filter or the journal _PID. Defaults to None.
 
         Returns:
             int: process id
@@ -150,105 +386,98 @@ class Intercept:
         service_id = 0                  # Init process id
         inc_service_id = False          # See if we should inc service id
 
-        if 'inc_service_id' in self.Parser.modules[mod_name]:
-            if self.Parser.modules[mod_name]['inc_service_id']:
-                unixtime = str(self.Base.get_unixtime())
-                inc_service_id = True
+        if rules.inc_service_id:
+            unixtime = str(self.Base.get_unixtime())
+            inc_service_id = True
 
-        #for mod_name in self.Parser.module_names:
-        pattern_service_id = self.Parser.modules[mod_name]['rgx_service_id']
-        lookup_service_id = re.search(pattern_service_id, output)
-        if lookup_service_id:
-            list_search = list(lookup_service_id.groups())
-            service_id = int(list_search[0])
+        if not service_id_field is None:
+            service_id = self.Base.convert_to_integer(service_id_field)
+        else:
+            lookup_service_id = rules.service_id.search(output)
+            if lookup_service_id:
+                list_search = list(lookup_service_id.groups())
+                service_id = int(list_search[0])
 
         if inc_service_id:
             service_id = f'{service_id}_{unixtime}'
 
         return service_id
 
-    def get_ipv4_address(self, output:str, mod_name:str) -> Union[str, None]:
+    def get_ip_address(self, output:str, rules:ModuleRules) -> str:
         """Retourn l'adresse ip si disponible
+        filters_ip first, then the first ipv4 and finally the first ipv6
 
         Args:
             output (str): journalctl output
+            rules (ModuleRules): The compiled rules of the module
 
         Returns:
-            str: ip address (IPV4)
+            str: ip address or the default ip if not available
         """
-        ip_address = None                  # Init ip address
+        for filter_ip_pattern in rules.filters_ip:
+            lookup_ip = filter_ip_pattern.search(output)
+            if lookup_ip:
+                list_search = list(lookup_ip.groups())
+                ip = self.normalize_ip(list_search[0])
+                if not ip is None:
+                    return ip
+
+        for pattern in (self.__PATTERN_IPV4, self.__PATTERN_IPV6):
+            for lookup_ip_address in pattern.finditer(output):
+                ip = self.normalize_ip(lookup_ip_address.group(1))
+                if not ip is None:
+                    return ip
+
+        return self.default_ip
+
+    def normalize_ip(self, ip:Union[str, None]) -> Union[str, None]:
+        """Retourne l'adresse ip sous sa forme canonique
+        2001:DB8:0:0::1 => 2001:db8::1, ::ffff:1.2.3.4 => 1.2.3.4, [2001:db8::1] => 2001:db8::1
 
-        if self.subprocess_detail[mod_name] == self.subprocess:
-            if 'filters_ip' in self.Parser.modules[mod_name]:
-                for key, filter_ip_pattern in self.Parser.modules[mod_name]['filters_ip'].items():
-                    lookup_ip = re.search(filter_ip_pattern, output)
-                    if lookup_ip:
-                        list_search = list(lookup_ip.groups())
-                        ip_address = list_search[0]
-                        return ip_address
+        Args:
+            ip (str | None): The ip address found in the line
 
-        lookup_ip_address = re.search(self.__PATTERN_IPV4, output)
-        if lookup_ip_address:
-            list_search = list(lookup_ip_address.groups())
-            ip_address = list_search[0]
+        Returns:
+            str | None: The canonical ip address or None if it's not a valid ip address
+        """
+        if not ip:
+            return None
 
-        return ip_address
+        try:
+            address = ipaddress.ip_address(ip.strip('[]'))
+        except ValueError:
+            return None
 
-    def get_ipv6_address(self, output:str, mod_name:str) -> Union[str, None]:
-        """Retourn l'adresse ip si disponible
+        if address.version == 6 and not address.ipv4_mapped is None:
+            address = address.ipv4_mapped
 
-        Args:
-            output (str): journalctl output
+        return str(address)
 
-        Returns:
-            str: ip address (IPV6)
-        """
-        ip_address = None                  # Init ip address
-        if self.subprocess_detail[mod_name] == self.subprocess:
-            if 'filters_ip' in self.Parser.modules[mod_name]:
-                for key, filter_ip_pattern in self.Parser.modules[mod_name]['filters_ip'].items():
-                    lookup_ip = re.search(filter_ip_pattern, output)
-                    if lookup_ip:
-                        list_search = list(lookup_ip.groups())
-                        ip_address = list_search[0]
-                        return ip_address
-
-        lookup_ip_address = re.search(self.__PATTERN_IPV6, output)
-        if lookup_ip_address:
-            list_search = list(lookup_ip_address.groups())
-            ip_address = list_search[0]
-
-        return ip_address
-
-    def get_users_attempt(self, output:str, mod_name:str) -> Union[str, None]:
+    def get_users_attempt(self, output:str, rules:ModuleRules) -> Union[str, None]:
         """Retourn le user si disponible
 
         Args:
             output (str): journalctl output
+            rules (ModuleRules): The compiled rules of the module
 
         Returns:
             str | None: if available user
         """
         user = None
-        patterns = [
-            r'.*user=(\w*)',
-            r'^.*Invalid user\s(\D*?)\s.*$',
-            r'^.*\b(\w+)\s+from.*$'
-        ]
-
-        if self.subprocess_detail[mod_name] == self.subprocess:
-            if 'rgx_username' in self.Parser.modules[mod_name]:
-                pattern = self.Parser.modules[mod_name]['rgx_username']
-                lookup_user = re.search(pattern, output)
-                if lookup_user:
-                    list_search = list(lookup_user.groups())
-                    user = list_search[0]
-                    return user
-
-        for pattern in patterns:
-            lookup_user = re.search(pattern, output)
+
+        if not rules.username is None:
+            lookup_user = rules.username.search(output)
+            if lookup_user:
+                list_search = list(lookup_user.groups())
+                user = list_search[0]
+                return user
+
+        # The last generic pattern that matches wins
+        for pattern in reversed(self.__PATTERNS_USER):
+            lookup_user = pattern.search(output)
             if lookup_user:
                 list_search = list(lookup_user.groups())
                 user = list_search[0]
+                return user
 
         return user
\ No newline at end of file
@@ -1,7 +1,7 @@
-from subprocess import Popen, PIPE
+from subprocess import Popen
 from typing import Union
-import os
-from core import parser, base, intercept
+from core import parser, base, follower, journal
+from core.rules import ModuleRules, compile_source
 
 class InterceptProcess:
 
@@ -9,7 +9,8 @@ class InterceptProcess:
         # Initialiser les processus
 
         self.subprocess:list[Popen[bytes]] = []
-        self.subprocess_detail:dict = {}
+        self.journal:Union[journal.JournalReader, None] = None    # Read journald for the modules without source_log
+        self.follower:Union[follower.LogFollower, None] = None    # Follow the modules with a source_log
 
         self.Parser = parser
         self.Base = base
@@ -20,61 +21,42 @@ class InterceptProcess:
         return None
 
     def init_processes(self) -> None:
-
-        isJournalctl = False            # Verifier si un process journal doit etre lancé
-        module_names_with_single_subprocess = []
+        """Build the dispatch index: one reader by log source
+        and the exact list of compiled modules attached to it.
+        - One JournalReader (journalctl -f -o json) for the modules without source_log
+        - One LogFollower for all the modules with a source_log (path or glob pattern)
+        """
+        journal_modules:list[ModuleRules] = []
+        file_sources:dict[str, list[ModuleRules]] = {}
 
         for mod_name in self.Parser.module_names:
             # proc = ["sshd","dovecot","proftpd"]
-            if 'source_log' in self.Parser.modules[mod_name]:
-                # Run subprocess with log source location
-                source_log = self.Parser.modules[mod_name]['source_log']
-                subprocess = self._create_subprocess(source_log)
-                self.subprocess_detail[mod_name] = subprocess
+            rules = self.Parser.rules[mod_name]
+            if rules.source_log is None:
+                journal_modules.append(rules)
             else:
-                # Run subprocess with journalctl -f
-                isJournalctl = True
-                module_names_with_single_subprocess.append(mod_name)
-
-        if isJournalctl:
-            subprocess = self._create_subprocess()
-            for mod_name_ssprocess in module_names_with_single_subprocess:
-                self.subprocess_detail[mod_name_ssprocess] = subprocess
-
-        return None
-
-    def _create_subprocess(self, logs_source:str=None) -> Union[Popen[bytes], None]:
-
-        if logs_source is None:
-            process = Popen(['journalctl', '-f', '-n', '0'], stdout=PIPE, stderr=PIPE)
-            self.subprocess.append(process)
-            return process
+                file_sources.setdefault(rules.source_log, []).append(rules)
 
-        if not os.path.exists(logs_source):
-            self.Base.logs.critical(f'{self._create_subprocess.__name__} - {logs_source} - no such directory or file')
-            return None
+        if journal_modules:
+            source_rules = compile_source(None, journal_modules)
+            self.journal = journal.JournalReader(self.Base, self.Parser, source_rules)
+            self.subprocess.append(self.journal.subprocess)
+            self.Base.logs.debug(f'Source journalctl - modules: {[rules.module_name for rules in journal_modules]}')
 
-        process = Popen(['tail', '-f','-n', '0', logs_source], stdout=PIPE, stderr=PIPE)
+        if file_sources:
+            self.follower = follower.LogFollower(self.Base, self.Parser, file_sources)
+            self.Base.logs.debug(f'Source files - {list(file_sources)}')
 
-        self.subprocess.append(process)
-
-        return process
+        return None
 
     def create_threads_for_processes(self) -> None:
-        """Execute chaque subprocess dans un thread séparé
+        """Execute chaque lecteur de logs dans un thread séparé
         """
 
-        for subprocess in self.subprocess:
-            self.Base.create_thread(self._run_subprocess, func_args=(subprocess, ), func_name=str(subprocess.args))
-
-        return None
-
-    def _run_subprocess(self, subprocess:Popen[bytes]) -> None:
+        if not self.journal is None:
+            self.Base.create_thread(self.journal.run, func_name=str(self.journal.subprocess.args))
 
-        Intercept = intercept.Intercept(self.Base, self.Parser, subprocess, self.subprocess_detail)
+        if not self.follower is None:
+            self.Base.create_thread(self.follower.run, func_name='LogFollower')
 
-        while True:
-            output = subprocess.stdout.readline().decode('utf-8').strip()
-            if output:
-                Intercept.run_process(output)
-                self.Base.logs.debug(f'raw: {output}')
+        return None
@@ -0,0 +1,208 @@
+import os, re, json, time
+from subprocess import Popen, PIPE
+from typing import Union
+from core import base, parser, intercept
+from core.rules import SourceRules
+from core.prefilter import Prefilter, journal_keyword
+
+class JournalReader:
+    '''### Read journald through journalctl -o json
+    - The journal_match of the modules are pushed down to journalctl
+    - The service name and the pid come as fields (SYSLOG_IDENTIFIER, _PID)
+    - The cursor is saved in db/journal.cursor, a restart catches up from the last entry read
+    '''
+
+    READ_BUFFER_SIZE = 64 * 1024                        # Max bytes read from the pipe in one call
+    SAVE_INTERVAL = 10                                  # Seconds between two saves of the cursor
+    OUTPUT_FIELDS = ['MESSAGE', 'SYSLOG_IDENTIFIER', '_PID', '_COMM', '_SYSTEMD_UNIT', '_HOSTNAME']
+
+    __PATTERN_CURSOR = re.compile(rb'"__CURSOR"\s*:\s*"([^"]+)"')
+    __PATTERN_BINARY_FIELD = re.compile(rb'"\s*:\s*\[')  # A field written as an array of bytes (non printable or non utf-8 value)
+
+    def __init__(self, base:base.Base, parser:parser.Parser, source_rules:SourceRules) -> None:
+
+        self.Base = base
+        self.Parser = parser
+        self.source_rules = source_rules
+
+        self.cursor_file = f'db{os.sep}journal.cursor'
+        self.cursor:Union[str, None] = self.load_cursor()
+        self.last_save = time.time()
+
+        self.prefilter = self.build_prefilter()
+        self.subprocess:Popen[bytes] = Popen(self.build_command(), stdout=PIPE, stderr=PIPE)
+
+        return None
+
+    def build_matches(self) -> list[str]:
+        """Build the journalctl matches from the journal_match of the modules.
+        Same field => OR, different fields => AND, modules separated by "+"
+
+        Returns:
+            list[str]: The journalctl matches, empty if one module has no journal_match
+        """
+        matches:list[str] = []
+
+        for rules in self.source_rules.modules:
+            if not rules.journal_match:
+                return []
+
+            if matches:
+                matches.append('+')
+
+            for field, values in rules.journal_match.items():
+                for value in sorted(values):
+                    matches.append(f'{field}={value}')
+
+        return matches
+
+    def build_command(self) -> list[str]:
+
+        output_fields = set(self.OUTPUT_FIELDS)
+        for rules in self.source_rules.modules:
+            output_fields.update(rules.journal_match)
+
+        command = ['journalctl', '-f', '-o', 'json', f'--output-fields={",".join(sorted(output_fields))}']
+
+        if self.cursor is None:
+            command += ['-n', '0']
+        else:
+            command.append(f'--after-cursor={self.cursor}')
+
+        matches = self.build_matches()
+        if not matches:
+            self.Base.logs.info('journalctl - at least one module has no journal_match, reading the whole journal')
+
+        command += matches
+        self.Base.logs.debug(f'journalctl command: {command}')
+
+        return command
+
+    def build_prefilter(self) -> Union[Prefilter, None]:
+        """The keywords prefilter of the source, adapted to the raw json entries
+
+        Returns:
+            Prefilter | None: The prefilter or None if the raw entries can't be prefiltered
+        """
+        if self.source_rules.prefilter is None:
+            return None
+
+        keywords = [journal_keyword(keyword) for keyword in self.source_rules.prefilter.keywords]
+        if None in keywords:
+            return None
+
+        return Prefilter(keywords)
+
+    def format_entry(self, entry:dict) -> tuple[str, dict]:
+        """Rebuild the short text line from a json entry
+
+        Args:
+            entry (dict): The journal entry
+
+        Returns:
+            tuple[str, dict]: ("host ident[pid]: message", {field: value})
+        """
+        fields:dict = {}
+        for field, value in entry.items():
+            if type(value) == list:
+                # Binary value (array of bytes) or field with several values
+                if value and type(value[0]) == int:
+                    value = bytes(value).decode('utf-8', errors='replace')
+                else:
+                    value = str(value[0]) if value else ''
+            fields[field] = value
+
+        identifier = fields.get('SYSLOG_IDENTIFIER') or fields.get('_COMM', '')
+        pid = fields.get('_PID')
+        service = f'{identifier}[{pid}]' if pid else identifier
+        message = fields.get('MESSAGE') or ''
+
+        return f"{fields.get('_HOSTNAME', '')} {service}: {message}".strip(), fields
+
+    def run(self) -> None:
+        """Read the journal entries until journalctl stops
+        this method must be run in a thread
+        """
+        Intercept = intercept.Intercept(self.Base, self.Parser, self.source_rules)
+        debug = self.Base.logs.getLogger().isEnabledFor(self.Base.logs.DEBUG)
+        prefilter = self.prefilter
+
+        file_descriptor = self.subprocess.stdout.fileno()
+        pending = b''
+
+        while True:
+            chunk = os.read(file_descriptor, self.READ_BUFFER_SIZE)
+            if not chunk:
+                self.Base.logs.critical(f'{self.run.__name__} - {self.subprocess.args} - journalctl stopped')
+                break
+
+            lines = chunk.split(b'\n')
+            lines[0] = pending + lines[0]
+            pending = lines.pop()           # The last line is not complete yet
+
+            for line in lines:
+                if debug:
+                    self.Base.logs.debug(f"raw: {line.decode('utf-8', errors='replace')}")
+
+                # The keywords of a binary field are not in the raw entry, the rebuilt line is prefiltered instead
+                binary_entry = not self.__PATTERN_BINARY_FIELD.search(line) is None
+
+                if not prefilter is None and not binary_entry and not prefilter.is_candidate(line):
+                    continue
+
+                try:
+                    entry = json.loads(line)
+                except json.decoder.JSONDecodeError:
+                    continue
+
+                output, fields = self.format_entry(entry)
+
+                if not prefilter is None and binary_entry and not self.source_rules.prefilter.is_candidate(output):
+                    continue
+
+                Intercept.run_entry(output, fields)
+
+            if lines:
+                lookup_cursor = self.__PATTERN_CURSOR.search(lines[-1])
+                if lookup_cursor:
+                    self.cursor = lookup_cursor.group(1).decode('utf-8')
+
+            if time.time() - self.last_save >= self.SAVE_INTERVAL:
+                self.save_cursor()
+
+        return None
+
+    def stop(self) -> None:
+        """Stop journalctl and save the cursor
+        """
+        self.subprocess.terminate()
+        self.save_cursor()
+
+        return None
+
+    def load_cursor(self) -> Union[str, None]:
+
+        if not os.path.exists(self.cursor_file):
+            return None
+
+        with open(self.cursor_file, 'r') as cursor:
+            value = cursor.read().strip()
+
+        return value if value else None
+
+    def save_cursor(self) -> None:
+
+        self.last_save = time.time()
+
+        if self.cursor is None:
+            return None
+
+        temporary_file = f'{self.cursor_file}.tmp'
+        try:
+            with open(temporary_file, 'w') as file:
+                file.write(self.cursor)
+            os.replace(temporary_file, self.cursor_file)
+        except OSError as error:
+            self.Base.logs.error(f'{self.save_cursor.__name__} - {self.cursor_file} - {error}')
+
+        return None
@@ -0,0 +1,215 @@
+from typing import TYPE_CHECKING, Callable
+from core.partitions import Partitions
+
+if TYPE_CHECKING:
+    from core.base import Base
+
+class Migrations:
+    '''### Versioned migrations of the database schema (db/software.db)
+    - The schema version is stored in PRAGMA user_version
+    - Every migration runs in one transaction with the update of user_version
+    - A new database is created by Base with the latest schema, no migration is needed
+    - auto_vacuum is switched to incremental (one VACUUM for the existing databases)
+    '''
+
+    # createdOn / updatedOn: '%Y-%m-%d %H:%M:%S' local time => epoch seconds
+    __TEXT_TO_EPOCH = "CASE WHEN typeof({column}) = 'text' THEN CAST(strftime('%s', {column}, 'utc') AS INTEGER) ELSE {column} END"
+
+    __EPOCH_TABLES = {
+        'logs': '''(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            createdOn INTEGER,
+            intrusion_service_id TEXT,
+            intrusion_detail TEXT,
+            module_name TEXT,
+            ip_address TEXT,
+            keyword TEXT,
+            user TEXT
+            )''',
+        'iptables': '''(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            createdOn INTEGER,
+            module_name TEXT,
+            ip_address TEXT,
+            duration INTEGER
+            )''',
+        'iptables_logs': '''(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            createdOn INTEGER,
+            module_name TEXT,
+            ip_address TEXT,
+            duration INTEGER
+            )''',
+        'hq_information': '''(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            createdOn INTEGER,
+            updatedOn INTEGER,
+            ip_address TEXT,
+            ab_score INTEGER,
+            hq_totalReports INTEGER
+            )''',
+        'hq_information_to_report': '''(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            createdOn INTEGER,
+            id_log INTEGER
+            )'''
+    }
+
+    def __init__(self, base:'Base') -> None:
+
+        self.Base = base
+        self.migrations:list[tuple[int, str, Callable[[], list[str]]]] = [
+            (1, 'createdOn / updatedOn stored as integer epoch seconds', self.migration_epoch_timestamps),
+            (2, 'logs and iptables_logs partitioned by day', self.migration_daily_partitions),
+            (3, 'intrusion_detail stored as template and variables', self.migration_intrusion_templates)
+        ]
+        self.latest_version = self.migrations[-1][0]
+
+        return None
+
+    def get_version(self) -> int:
+
+        return int(self.Base.db_execute_query('PRAGMA user_version').scalar())
+
+    def is_new_database(self) -> bool:
+
+        query = "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'iptables'"
+
+        return self.Base.db_execute_query(query).scalar() == 0
+
+    def get_columns(self, table_name:str) -> list[str]:
+
+        return [row[1] for row in self.Base.db_execute_query(f'PRAGMA table_info({table_name})').fetchall()]
+
+    def run(self) -> int:
+        """Apply the pending migrations
+
+        Returns:
+            int: The schema version of the database
+        """
+        version = self.get_version()
+
+        if version == 0 and self.is_new_database():
+            self.enable_incremental_vacuum()
+            self.execute([f'PRAGMA user_version = {self.latest_version}'])
+            return self.latest_version
+
+        for migration_version, description, migration in self.migrations:
+            if migration_version <= version:
+                continue
+
+            self.Base.logs.info(f'Database migration {migration_version} - {description}')
+            self.execute(migration() + [f'PRAGMA user_version = {migration_version}'])
+            version = migration_version
+
+        if self.Base.db_execute_query('PRAGMA auto_vacuum').scalar() != 2:
+            self.Base.logs.info('Database migration - auto_vacuum incremental (VACUUM of the database)')
+            self.enable_incremental_vacuum()
+
+        return version
+
+    def enable_incremental_vacuum(self) -> None:
+        """Switch auto_vacuum to incremental, VACUUM can't run inside a transaction
+        """
+        with self.Base.lock:
+            dbapi_connection = self.Base.engine.raw_connection()
+            try:
+                dbapi_cursor = dbapi_connection.cursor()
+                dbapi_cursor.executescript('PRAGMA auto_vacuum = INCREMENTAL;\nVACUUM;')
+            finally:
+                dbapi_connection.close()
+
+        return None
+
+    def execute(self, statements:list[str]) -> None:
+        """Run the statements in one transaction (DDL included)
+
+        Args:
+            statements (list[str]): The sql statements
+        """
+        with self.Base.lock:
+            dbapi_connection = self.Base.engine.raw_connection()
+            try:
+                dbapi_cursor = dbapi_connection.cursor()
+                try:
+                    dbapi_cursor.executescript('BEGIN;\n' + ';\n'.join(statements) + ';\nCOMMIT;')
+                except Exception:
+                    dbapi_cursor.execute('ROLLBACK')
+                    raise
+            finally:
+                dbapi_connection.close()
+
+        return None
+
+    def migration_epoch_timestamps(self) -> list[str]:
+        """Rebuild the tables with integer createdOn / updatedOn
+        the existing text dates are converted by sqlite, the indexes are created again by Base
+
+        Returns:
+            list[str]: The statements of the migration
+        """
+        statements:list[str] = []
+
+        for table_name, definition in self.__EPOCH_TABLES.items():
+            columns = self.get_columns(table_name)
+            if not columns:
+                continue
+
+            selected_columns = [
+                self.__TEXT_TO_EPOCH.format(column=column) if column in ('createdOn', 'updatedOn') else column
+                for column in columns
+            ]
+
+            statements += [
+                f'CREATE TABLE {table_name}_migration {definition}',
+                f"INSERT INTO {table_name}_migration ({', '.join(columns)}) SELECT {', '.join(selected_columns)} FROM {table_name}",
+                f'DROP TABLE {table_name}',
+                f'ALTER TABLE {table_name}_migration RENAME TO {table_name}'
+            ]
+
+        return statements
+
+    def migration_daily_partitions(self) -> list[str]:
+        """Move the rows of logs and iptables_logs into their daily partitions (logs_20240217 ...)
+        the views and the indexes of the partitions are created by Base (Partitions)
+
+        Returns:
+            list[str]: The statements of the migration
+        """
+        statements:list[str] = []
+        row_day = "strftime('%Y%m%d', COALESCE(createdOn, CAST(strftime('%s', 'now') AS INTEGER)), 'unixepoch', 'localtime')"
+
+        for table_name, definition in Partitions.PARTITIONED_TABLES.items():
+            columns = self.get_columns(table_name)
+            if not columns:
+                continue
+
+            query_days = f'SELECT DISTINCT {row_day} FROM {table_name}'
+            for day, in self.Base.db_execute_query(query_days).fetchall():
+                statements += [
+                    f'CREATE TABLE IF NOT EXISTS {table_name}_{day} {definition}',
+                    f"INSERT INTO {table_name}_{day} ({', '.join(columns)}) SELECT {', '.join(columns)} FROM {table_name} WHERE {row_day} = '{day}'"
+                ]
+
+            statements.append(f'DROP TABLE {table_name}')
+
+        return statements
+
+    def migration_intrusion_templates(self) -> list[str]:
+        """Add the template columns to the existing logs partitions
+        the rows already recorded keep their raw intrusion_detail
+
+        Returns:
+            list[str]: The statements of the migration
+        """
+        statements:list[str] = []
+        query = "SELECT name FROM sqlite_master WHERE type = 'table' AND name GLOB 'logs_[0-9]*'"
+
+        for partition, in self.Base.db_execute_query(query).fetchall():
+            columns = self.get_columns(partition)
+            if not 'intrusion_template_id' in columns:
+                statements.append(f'ALTER TABLE {partition} ADD COLUMN intrusion_template_id INTEGER')
+            if not 'intrusion_variables' in columns:
+                statements.append(f'ALTER TABLE {partition} ADD COLUMN intrusion_variables TEXT')
+
+        return statements
@@ -1,5 +1,7 @@
-import json, os
+import json, os, re
 from core import base
+from core.rules import ModuleRules, compile_module
+from core.whitelist import IpWhitelist
 
 class Parser:
 
@@ -11,14 +13,20 @@ class Parser:
         self.global_ip_exceptions:list = []             # Global ip exceptions
 
         self.module_names:list = []                     # List of module names () ==> ["sshd","dovecot","proftpd"]
+        self.rules:dict[str, ModuleRules] = {}          # Compiled rules by module name
         self.filenames:list = []                        # Liste contenant le nom des fichiers de configuration json
         self.errors:list = []                           # check errors
 
         self.load_global_json_configuration()
         self.load_json_configuration()
         self.parse_json()
+        self.compile_rules()
 
         self.Base.whitelisted_ip = list(set(self.Base.local_whitelisted_ip + self.Base.global_whitelisted_ip))
+        self.Base.global_whitelist = IpWhitelist(self.Base.global_whitelisted_ip)
+        self.Base.whitelist = IpWhitelist(self.Base.whitelisted_ip)
+        for invalid_ip in self.Base.whitelist.invalid:
+            self.errors.append(f'Invalid ip exception "{invalid_ip}" (ip address or CIDR range expected)')
         self.Base.logs.debug(f"Global Whitelisted ip : {self.Base.global_whitelisted_ip}")
         self.Base.logs.debug(f"Local Whitelisted ip : {self.Base.local_whitelisted_ip}")
         self.Base.logs.debug(f"All Whitelisted ip : {self.Base.whitelisted_ip}")
@@ -129,6 +137,30 @@ class Parser:
         self.Base.logs.debug(f"self.module_names : {self.module_names}")
         return None
 
+    def compile_rules(self) -> None:
+        """Compile the regex of every loaded module once.
+        A module with an invalid regex is disabled and reported as a configuration error
+        """
+        for module_name in self.module_names.copy():
+            try:
+                self.rules[module_name] = compile_module(self.modules[module_name])
+                if len(self.rules[module_name].filters) > 1 and self.rules[module_name].filters_matcher is None:
+                    self.Base.logs.warning(f'{module_name} - the filters can not be combined (backreference or inline flags), one regex by filter')
+            except (re.error, ValueError) as rule_error:
+                self.errors.append(f'Invalid rule in module {module_name} : {rule_error}')
+                self.module_names.remove(module_name)
+
+        self.Base.logs.debug(f"Compiled rules : {list(self.rules)}")
+
+        # Reload the attempts still in the find window of each module
+        windows = {
+            module_name: int(rules.actions.get('find_window', self.Base.default_find_window))
+            for module_name, rules in self.rules.items()
+        }
+        self.Base.db_load_attempts(windows)
+
+        return None
+
     def check_json_structure(self, json_data:dict, filename:str) -> bool:
 
         response = True
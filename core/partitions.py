@@ -0,0 +1,239 @@
+import time
+from typing import TYPE_CHECKING, Union
+
+if TYPE_CHECKING:
+    from core.base import Base
+
+class Partitions:
+    '''### Daily partitions of the event tables (logs, iptables_logs)
+    - One table by day: logs_20240217, iptables_logs_20240217 ...
+    - A view with the name of the table (logs, iptables_logs) is the UNION ALL of its partitions, used for the reads
+    - The writes go to the partition of the day of the row (get_table)
+    - The retention drops the whole partitions, the freed pages are given back by chunks (vacuum)
+    - At most MAX_PARTITIONS days by table, even without retention (sqlite limits the terms of a compound select)
+    '''
+
+    PARTITIONED_TABLES = {
+        'logs': '''(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            createdOn INTEGER,
+            intrusion_service_id TEXT,
+            intrusion_detail TEXT,
+            module_name TEXT,
+            ip_address TEXT,
+            keyword TEXT,
+            user TEXT,
+            intrusion_template_id INTEGER,
+            intrusion_variables TEXT
+            )''',
+        'iptables_logs': '''(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            createdOn INTEGER,
+            module_name TEXT,
+            ip_address TEXT,
+            duration INTEGER
+            )'''
+    }
+
+    PARTITIONED_INDEXES = {
+        'logs': [
+            '(module_name, ip_address, createdOn)',
+            '(ip_address)',
+            '(createdOn, module_name, ip_address, intrusion_service_id)',
+            '(intrusion_template_id)'
+        ],
+        'iptables_logs': [
+            '(createdOn)'
+        ]
+    }
+
+    DAY_FORMAT = '%Y%m%d'
+    MAX_PARTITIONS = 400                                # Partitions by view, below SQLITE_MAX_COMPOUND_SELECT (500)
+    VACUUM_PAGES = 2000                                 # Pages given back by incremental_vacuum under the lock
+    VACUUM_CHUNKS = 100                                 # incremental_vacuum by cycle, the remaining pages wait for the next cycle
+
+    def __init__(self, base:'Base') -> None:
+
+        self.Base = base
+        self.partitions:dict[str, set[str]] = {}       # {table name: {day}}
+
+        for table_name in self.PARTITIONED_TABLES:
+            self.partitions[table_name] = set(self.load_days(table_name))
+            for partition in self.get_tables(table_name):
+                self.create_indexes(table_name, partition)
+            if len(self.partitions[table_name]) >= self.MAX_PARTITIONS:
+                self.purge(table_name, None)
+            self.get_table(table_name, self.Base.get_unixtime())
+            self.create_view(table_name)
+
+        return None
+
+    def load_days(self, table_name:str) -> list[str]:
+        """The days of the existing partitions
+
+        Args:
+            table_name (str): The partitioned table name
+
+        Returns:
+            list[str]: ['20240217', ...]
+        """
+        query = "SELECT name FROM sqlite_master WHERE type = 'table' AND name GLOB :pattern"
+        pattern = f"{table_name}_{'[0-9]' * 8}"
+
+        return [name.removeprefix(f'{table_name}_') for name, in self.Base.db_execute_query(query, {'pattern': pattern}).fetchall()]
+
+    def get_day(self, unixtime:int) -> str:
+
+        return time.strftime(self.DAY_FORMAT, time.localtime(unixtime))
+
+    def get_table(self, table_name:str, unixtime:int) -> str:
+        """The partition of the row, created with its indexes if needed
+
+        Args:
+            table_name (str): The partitioned table name
+            unixtime (int): The createdOn of the row
+
+        Returns:
+            str: The partition name (logs_20240217)
+        """
+        day = self.get_day(unixtime)
+        partition = f'{table_name}_{day}'
+
+        if day in self.partitions[table_name]:
+            return partition
+
+        with self.Base.lock:
+            if not day in self.partitions[table_name]:
+                if len(self.partitions[table_name]) >= self.MAX_PARTITIONS:
+                    self.purge(table_name, None)
+                self.Base.db_execute_query(f'CREATE TABLE IF NOT EXISTS {partition} {self.PARTITIONED_TABLES[table_name]}')
+                self.create_indexes(table_name, partition)
+                self.partitions[table_name].add(day)
+                self.create_view(table_name)
+                self.Base.logs.debug(f'Partition {partition} created')
+
+        return partition
+
+    def create_indexes(self, table_name:str, partition:str) -> None:
+
+        for position, columns in enumerate(self.PARTITIONED_INDEXES[table_name]):
+            self.Base.db_execute_query(f'CREATE INDEX IF NOT EXISTS idx_{partition}_{position} ON {partition} {columns}')
+
+        return None
+
+    def get_tables(self, table_name:str) -> list[str]:
+
+        return [f'{table_name}_{day}' for day in sorted(self.partitions[table_name])]
+
+    def create_view(self, table_name:str) -> None:
+        """Create again the view of the table with all its partitions
+
+        Args:
+            table_name (str): The partitioned table name
+
+        Raises:
+            OverflowError: More than MAX_PARTITIONS partitions, sqlite would refuse the view
+        """
+        if len(self.partitions[table_name]) > self.MAX_PARTITIONS:
+            raise OverflowError(f'{table_name}: {len(self.partitions[table_name])} partitions, the view is limited to {self.MAX_PARTITIONS}')
+
+        selects = '\nUNION ALL\n'.join(f'SELECT * FROM {partition}' for partition in self.get_tables(table_name))
+
+        with self.Base.lock:
+            self.Base.db_execute_query(f'DROP VIEW IF EXISTS {table_name}')
+            self.Base.db_execute_query(f'CREATE VIEW {table_name} AS {selects}')
+
+        return None
+
+    def delete(self, table_name:str, condition:str, params:dict = {}) -> int:
+        """Delete the rows matching the condition in every partition (chunked)
+
+        Args:
+            table_name (str): The partitioned table name
+            condition (str): The WHERE condition of the rows to delete
+            params (dict, optional): The parameters of the condition. Defaults to {}.
+
+        Returns:
+            int: The number of rows deleted
+        """
+        deleted = 0
+        for partition in self.get_tables(table_name):
+            deleted += self.Base.db_delete_chunked(partition, condition, params)
+
+        return deleted
+
+    def purge(self, table_name:str, unixtime:Union[int, None]) -> int:
+        """Remove the rows created before unixtime
+        the partitions entirely older are dropped, the partition of the limit is cleaned by chunks
+        the partitions older than MAX_PARTITIONS days are always dropped
+
+        Args:
+            table_name (str): The partitioned table name
+            unixtime (Union[int, None]): The retention limit, None if the table has no retention
+
+        Returns:
+            int: The number of rows deleted in the partition of the limit (the rows of the dropped partitions are not counted)
+        """
+        now = self.Base.get_unixtime()
+        max_partitions_limit = now - (self.MAX_PARTITIONS - 1) * 86400
+
+        if unixtime is None or unixtime < max_partitions_limit:
+            unixtime = max_partitions_limit
+            if any(day < self.get_day(unixtime) for day in self.partitions[table_name]):
+                self.Base.logs.warning(f'{table_name} - partitions older than {self.MAX_PARTITIONS} days dropped, set retention_hours.{table_name} below')
+
+        limit_day = self.get_day(unixtime)
+        today = self.get_day(now)
+        removed = 0
+
+        expired_days = [day for day in sorted(self.partitions[table_name]) if day < limit_day and day != today]
+
+        if expired_days:
+            with self.Base.lock:
+                # The view is created again without the partitions before they are dropped
+                self.partitions[table_name].difference_update(expired_days)
+                self.create_view(table_name)
+
+            # One partition by statement, the lock is released between two drops
+            for day in expired_days:
+                partition = f'{table_name}_{day}'
+                self.Base.db_execute_query(f'DROP TABLE IF EXISTS {partition}')
+                self.Base.logs.debug(f'Partition {partition} dropped')
+                time.sleep(0)
+
+            self.Base.logs.info(f'{table_name} - {len(expired_days)} partition(s) dropped')
+
+        if limit_day in self.partitions[table_name]:
+            removed += self.Base.db_delete_chunked(f'{table_name}_{limit_day}', 'createdOn <= :unixtime', {'unixtime': unixtime})
+
+        return removed
+
+    def vacuum(self) -> int:
+        """Give back the free pages (dropped partitions, deleted rows) to the file system
+        VACUUM_PAGES pages by statement, the lock is released between two statements,
+        at most VACUUM_CHUNKS statements: the remaining pages are given back by the next cycles
+
+        Returns:
+            int: The number of pages given back
+        """
+        vacuumed = 0
+        free_pages = self.Base.db_execute_query('PRAGMA freelist_count').scalar() or 0
+
+        for i in range(self.VACUUM_CHUNKS):
+            if free_pages == 0:
+                break
+
+            with self.Base.lock:
+                # sqlite3 execute() steps a pragma once (one page), executescript runs it to the end
+                self.Base.cursor.connection.driver_connection.executescript(f'PRAGMA incremental_vacuum({self.VACUUM_PAGES})')
+                remaining_pages = self.Base.db_execute_query('PRAGMA freelist_count').scalar() or 0
+
+            # Nothing given back: auto_vacuum is not incremental
+            if remaining_pages >= free_pages:
+                break
+
+            vacuumed += free_pages - remaining_pages
+            free_pages = remaining_pages
+            time.sleep(0)
+
+        return vacuumed
@@ -0,0 +1,135 @@
+import re
+from typing import Union
+
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:
+    import sre_parse, sre_constants
+
+class Prefilter:
+    '''### Literal keyword prefilter
+    All the keywords of a log source are merged in one matcher,
+    a line without any keyword is discarded before any module regex runs.
+    '''
+
+    # Under this number of keywords a substring lookup is faster than the regex engine
+    SUBSTRING_MAX_KEYWORDS = 8
+
+    def __init__(self, keywords:list[str]) -> None:
+
+        self.keywords:tuple[str, ...] = tuple(sorted(set(keywords), key=len, reverse=True))
+
+        self.bytes_keywords:tuple[bytes, ...] = tuple(keyword.encode('utf-8') for keyword in self.keywords)
+
+        self.matcher:Union[re.Pattern, None] = None
+        self.bytes_matcher:Union[re.Pattern, None] = None
+        if len(self.keywords) > self.SUBSTRING_MAX_KEYWORDS:
+            self.matcher = re.compile('|'.join(re.escape(keyword) for keyword in self.keywords))
+            self.bytes_matcher = re.compile(b'|'.join(re.escape(keyword) for keyword in self.bytes_keywords))
+
+        return None
+
+    def is_candidate(self, line:Union[str, bytes]) -> bool:
+        """Check if the line contains at least one keyword
+
+        Args:
+            line (str | bytes): The log line, raw bytes are matched without being decoded
+
+        Returns:
+            bool: True if the line must be analysed by the modules
+        """
+        if type(line) == bytes:
+            keywords, matcher = self.bytes_keywords, self.bytes_matcher
+        else:
+            keywords, matcher = self.keywords, self.matcher
+
+        if matcher is None:
+            for keyword in keywords:
+                if keyword in line:
+                    return True
+            return False
+
+        return not matcher.search(line) is None
+
+_PATTERN_FORMAT_SEPARATORS = re.compile(r'[\[\]:\s"\\]+')
+
+def journal_keyword(keyword:str) -> Union[str, None]:
+    """Reduce a keyword to a literal that is found verbatim in a journalctl json entry.
+    The text line is rebuilt from several fields ("host ident[pid]: message"),
+    so the keyword can't cross a separator of this format
+
+    Args:
+        keyword (str): The keyword of the module
+
+    Returns:
+        str | None: The longest part of the keyword without separator, None if nothing remains
+    """
+    parts = _PATTERN_FORMAT_SEPARATORS.split(keyword)
+    part = max(parts, key=len)
+
+    return part if part else None
+
+def extract_keyword(pattern:re.Pattern) -> Union[str, None]:
+    """Extract the longest literal that every line matched by the pattern must contain
+
+    Args:
+        pattern (re.Pattern): The compiled regex (rgx_service_name)
+
+    Returns:
+        str | None: The keyword or None if no mandatory literal is available
+    """
+    if pattern.flags & re.IGNORECASE or not type(pattern.pattern) == str:
+        return None
+
+    try:
+        parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+    except re.error:
+        return None
+
+    runs:list[str] = []
+    last_run = _literal_runs(parsed, runs, '')
+    runs.append(last_run)
+
+    keyword = max(runs, key=len)
+
+    return keyword if keyword else None
+
+def _literal_runs(items, runs:list[str], current:str) -> str:
+    """Walk the parsed regex and collect the mandatory literal sequences
+
+    Args:
+        items: The parsed regex (sre_parse.SubPattern)
+        runs (list[str]): The completed literal sequences
+        current (str): The literal sequence in progress
+
+    Returns:
+        str: The literal sequence still in progress
+    """
+    for op, av in items:
+        if op is sre_constants.LITERAL:
+            current += chr(av)
+
+        elif op is sre_constants.AT:
+            # Anchors don't consume any character
+            continue
+
+        elif op is sre_constants.SUBPATTERN:
+            group, add_flags, del_flags, sub_pattern = av
+            if add_flags & sre_constants.SRE_FLAG_IGNORECASE:
+                runs.append(current)
+                current = ''
+                continue
+            current = _literal_runs(sub_pattern, runs, current)
+
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) and av[0] >= 1:
+            # The repeated content is mandatory but can't be chained with its neighbours
+            runs.append(current)
+            runs.append(_literal_runs(av[2], runs, ''))
+            current = ''
+
+        else:
+            # Alternation, character class, optional repeat ... nothing mandatory
+            runs.append(current)
+            current = ''
+
+    return current
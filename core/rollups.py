@@ -0,0 +1,147 @@
+import ipaddress
+from sqlalchemy.sql import text
+from typing import TYPE_CHECKING, Union
+
+if TYPE_CHECKING:
+    from core.base import Base
+
+class Rollups:
+    '''### Hourly aggregates of the logs table for the long-term statistics
+    - logs_hourly: attempts by hour, module, keyword, ip address and prefix (/24 for ipv4, /64 for ipv6)
+    - Incremental: only the complete hours after the watermark (rollups.rolled_until) are folded
+    - Run by clean_db_logs before the purge of the raw rows, the aggregates have their own retention
+    '''
+
+    HOUR = 3600
+    HOURS_BY_TRANSACTION = 24                           # Hours folded in one transaction
+    PREFIX = {4: 24, 6: 64}                             # Prefix length by ip version
+    GROUP_COLUMNS = ('module_name', 'keyword', 'ip_address', 'prefix')
+
+    def __init__(self, base:'Base') -> None:
+
+        self.Base = base
+
+        return None
+
+    def get_prefix(self, ip:str) -> Union[str, None]:
+
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+
+        return str(ipaddress.ip_network(f'{address}/{self.PREFIX[address.version]}', strict=False))
+
+    def get_rolled_until(self) -> Union[int, None]:
+        """The end of the last folded hour (watermark)
+
+        Returns:
+            Union[int, None]: The epoch of the watermark, the first hour of the logs table if never folded
+        """
+        query = "SELECT rolled_until FROM rollups WHERE table_name = 'logs_hourly'"
+        rolled_until = self.Base.db_execute_query(query).scalar()
+
+        if rolled_until is None:
+            first_created_on = self.Base.db_execute_query('SELECT MIN(createdOn) FROM logs').scalar()
+            if first_created_on is None:
+                return None
+            rolled_until = int(first_created_on) // self.HOUR * self.HOUR
+
+        return int(rolled_until)
+
+    def run(self) -> int:
+        """Fold the complete hours of the logs table into logs_hourly
+
+        Returns:
+            int: The number of attempts folded
+        """
+        current_hour = self.Base.get_unixtime() // self.HOUR * self.HOUR
+        rolled_until = self.get_rolled_until()
+        if rolled_until is None:
+            rolled_until = current_hour
+
+        query_logs = '''SELECT createdOn / 3600 * 3600 AS hour, module_name, keyword, ip_address, COUNT(*)
+                    FROM logs
+                    WHERE createdOn >= :start AND createdOn < :end AND ip_address != :default_ip
+                    GROUP BY hour, module_name, keyword, ip_address
+                '''
+        query_upsert = '''INSERT INTO logs_hourly (hour, module_name, keyword, ip_address, prefix, attempts)
+                    VALUES (:hour, :module_name, :keyword, :ip_address, :prefix, :attempts)
+                    ON CONFLICT (hour, module_name, keyword, ip_address) DO UPDATE SET attempts = attempts + excluded.attempts
+                '''
+        query_watermark = '''INSERT INTO rollups (table_name, rolled_until) VALUES ('logs_hourly', :rolled_until)
+                    ON CONFLICT (table_name) DO UPDATE SET rolled_until = excluded.rolled_until
+                '''
+        folded = 0
+
+        while rolled_until < current_hour:
+            end = min(rolled_until + self.HOURS_BY_TRANSACTION * self.HOUR, current_hour)
+            mes_donnees = {'start': rolled_until, 'end': end, 'default_ip': self.Base.default_ipv4}
+
+            rows = [
+                {
+                    'hour': hour, 'module_name': module_name, 'keyword': keyword, 'ip_address': ip,
+                    'prefix': self.get_prefix(ip), 'attempts': attempts
+                }
+                for hour, module_name, keyword, ip, attempts in self.Base.db_execute_query(query_logs, mes_donnees).fetchall()
+                if not ip in self.Base.whitelist
+            ]
+
+            # The aggregates and the watermark in the same transaction
+            with self.Base.lock:
+                if rows:
+                    self.Base.cursor.execute(text(query_upsert), rows)
+                self.Base.cursor.execute(text(query_watermark), {'rolled_until': end})
+                self.Base.cursor.commit()
+
+            folded += sum(row['attempts'] for row in rows)
+            rolled_until = end
+
+        if folded > 0:
+            self.Base.logs.debug(f'{folded} attempts folded into logs_hourly')
+
+        return folded
+
+    def get_timeline(self, hours:int, module_name:Union[str, None] = None) -> list[tuple[int, int]]:
+        """The attempts by hour
+
+        Args:
+            hours (int): The number of hours before now
+            module_name (Union[str, None], optional): Only this module. Defaults to None.
+
+        Returns:
+            list[tuple[int, int]]: [(hour epoch, attempts)] sorted by hour
+        """
+        query = '''SELECT hour, SUM(attempts) FROM logs_hourly
+                    WHERE hour >= :since AND (:module_name IS NULL OR module_name = :module_name)
+                    GROUP BY hour
+                    ORDER BY hour
+                '''
+        mes_donnees = {'since': self.Base.get_unixtime() - hours * self.HOUR, 'module_name': module_name}
+
+        return [(hour, attempts) for hour, attempts in self.Base.db_execute_query(query, mes_donnees).fetchall()]
+
+    def get_top(self, column:str, hours:int, limit:int = 10, module_name:Union[str, None] = None) -> list[tuple[str, int]]:
+        """The most active values of a column (module_name, keyword, ip_address, prefix)
+
+        Args:
+            column (str): The column to group by
+            hours (int): The number of hours before now
+            limit (int, optional): The number of values. Defaults to 10.
+            module_name (Union[str, None], optional): Only this module. Defaults to None.
+
+        Returns:
+            list[tuple[str, int]]: [(value, attempts)] sorted by attempts
+        """
+        if not column in self.GROUP_COLUMNS:
+            raise ValueError(f'{column} is not one of {self.GROUP_COLUMNS}')
+
+        query = f'''SELECT {column}, SUM(attempts) AS total FROM logs_hourly
+                    WHERE hour >= :since AND (:module_name IS NULL OR module_name = :module_name)
+                    GROUP BY {column}
+                    ORDER BY total DESC
+                    LIMIT :limit
+                '''
+        mes_donnees = {'since': self.Base.get_unixtime() - hours * self.HOUR, 'module_name': module_name, 'limit': limit}
+
+        return [(value, total) for value, total in self.Base.db_execute_query(query, mes_donnees).fetchall()]
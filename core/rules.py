@@ -0,0 +1,191 @@
+import re
+from types import MappingProxyType
+from typing import NamedTuple, Union
+from core.prefilter import Prefilter, extract_keyword
+from core.whitelist import IpWhitelist
+
+class ModuleRules(NamedTuple):
+    '''### Compiled and immutable rule set of a module
+    Built once by the Parser when the json modules are loaded,
+    used directly by the hot path (Intercept) for every log line.
+    '''
+    module_name: str                                    # The module name
+    source_log: Union[str, None]                        # The log source (None => journalctl)
+    service_name: re.Pattern                            # Compiled rgx_service_name
+    keywords: tuple[str, ...]                           # Literals required by the module (empty => no prefilter)
+    service_id: re.Pattern                              # Compiled rgx_service_id
+    inc_service_id: bool                                # Increment service id with the unixtime
+    username: Union[re.Pattern, None]                   # Compiled rgx_username if available
+    filters: tuple[tuple[str, re.Pattern], ...]         # ((filter_name, compiled filter), ...)
+    filters_matcher: Union[re.Pattern, None]            # All the filters merged in one pattern (None if not combinable)
+    filters_groups: MappingProxyType                    # {group name in filters_matcher: filter_name}
+    filters_ip: tuple[re.Pattern, ...]                  # Compiled filters_ip
+    ip_exceptions: IpWhitelist                          # Module ip exceptions (ip and CIDR ranges)
+    actions: MappingProxyType                           # The actions block of the module (read only)
+    journal_match: MappingProxyType                     # {journal field: frozenset(values)} pushed down to journalctl
+
+_PATTERN_BACKREFERENCE = re.compile(r'\\[1-9]|\(\?P=')
+_PATTERN_NAMED_GROUP = re.compile(r'\\.|\(\?P<(\w+)>')        # The escapes are matched to be skipped
+_PATTERN_GLOBAL_FLAGS = re.compile(r'^\(\?([aiLmsux]+)\)')
+_PATTERN_COMBINED_GROUP = re.compile(r'^_g\d+_')
+_PATTERN_JOURNAL_FIELD = re.compile(r'^[A-Z0-9_]+$')
+
+def combine_patterns(patterns: dict) -> tuple[Union[re.Pattern, None], MappingProxyType]:
+    """Merge several regex into one alternation of named groups,
+    one scan of the line tells which pattern matched (match.lastgroup)
+    - The named groups of the pattern n are renamed _g{n}_{name} (the same name can be used by many patterns), see field_name
+    - The leading inline flags (?i) are scoped to the pattern (?i:...)
+
+    Args:
+        patterns (dict): {name: regex}
+
+    Returns:
+        tuple[Pattern | None, MappingProxyType]: The combined pattern and the {group name: name} mapping.
+        The pattern is None if the regex can't be merged (backreferences, inline flags not at the beginning)
+    """
+    groups: dict[str, str] = {}
+    alternatives: list[str] = []
+
+    for position, (name, pattern) in enumerate(patterns.items()):
+        if _PATTERN_BACKREFERENCE.search(pattern):
+            return None, MappingProxyType({})
+
+        group_name = f'_g{position}'
+        groups[group_name] = name
+
+        pattern = _PATTERN_NAMED_GROUP.sub(
+            lambda lookup: lookup.group(0) if lookup.group(1) is None else f'(?P<{group_name}_{lookup.group(1)}>',
+            pattern
+        )
+
+        flags = _PATTERN_GLOBAL_FLAGS.match(pattern)
+        if flags:
+            pattern = f'(?{flags.group(1)}:{pattern[flags.end():]})'
+
+        alternatives.append(f'(?P<{group_name}>{pattern})')
+
+    if not alternatives:
+        return None, MappingProxyType({})
+
+    try:
+        combined = re.compile('|'.join(alternatives))
+    except re.error:
+        return None, MappingProxyType({})
+
+    return combined, MappingProxyType(groups)
+
+def field_name(group_name: str) -> str:
+    """The name of a group in its own pattern (_g1_ip => ip)
+
+    Args:
+        group_name (str): The group name in the pattern or in the combined pattern
+
+    Returns:
+        str: The group name without the prefix added by combine_patterns
+    """
+    if _PATTERN_COMBINED_GROUP.match(group_name):
+        return group_name.split('_', 2)[2]
+
+    return group_name
+
+def compile_module(module: dict) -> ModuleRules:
+    """Compile every regex of a json module
+
+    Args:
+        module (dict): The json module loaded by the Parser
+
+    Raises:
+        re.error: If one of the regex is not valid
+        ValueError: If a journal_match field is not valid
+
+    Returns:
+        ModuleRules: The compiled rule set of the module
+    """
+    filters = tuple(
+        (filter_name, re.compile(filter_value)) for filter_name, filter_value in module['filters'].items()
+    )
+
+    filters_matcher, filters_groups = combine_patterns(module['filters'])
+
+    filters_ip: tuple = ()
+    if type(module.get('filters_ip')) == dict:
+        filters_ip = tuple(re.compile(filter_ip) for filter_ip in module['filters_ip'].values())
+
+    ip_exceptions = module.get('ip_exceptions')
+    ip_exceptions = IpWhitelist(ip_exceptions) if type(ip_exceptions) == list else IpWhitelist()
+
+    username = re.compile(module['rgx_username']) if 'rgx_username' in module else None
+
+    # "journal_match": {"SYSLOG_IDENTIFIER": ["sshd", "sshd-session"], "_SYSTEMD_UNIT": "ssh.service"}
+    journal_match: dict[str, frozenset] = {}
+    if type(module.get('journal_match')) == dict:
+        for field, values in module['journal_match'].items():
+            if not _PATTERN_JOURNAL_FIELD.match(field):
+                raise ValueError(f'invalid journal field {field}')
+            values = values if type(values) == list else [values]
+            journal_match[field] = frozenset(str(value) for value in values)
+
+    service_name = re.compile(module['rgx_service_name'])
+
+    # Keywords declared in the module, otherwise extracted from rgx_service_name
+    if type(module.get('keywords')) == list:
+        keywords = tuple(str(keyword) for keyword in module['keywords'] if keyword)
+    else:
+        keyword = extract_keyword(service_name)
+        keywords = (keyword,) if not keyword is None else ()
+
+    return ModuleRules(
+        module_name=module['module_name'],
+        source_log=module.get('source_log'),
+        service_name=service_name,
+        keywords=keywords,
+        service_id=re.compile(module['rgx_service_id']),
+        inc_service_id=bool(module.get('inc_service_id', False)),
+        username=username,
+        filters=filters,
+        filters_matcher=filters_matcher,
+        filters_groups=filters_groups,
+        filters_ip=filters_ip,
+        ip_exceptions=ip_exceptions,
+        actions=MappingProxyType(dict(module['actions'])),
+        journal_match=MappingProxyType(journal_match)
+    )
+
+class SourceRules(NamedTuple):
+    '''### Dispatch entry of a log source
+    The exact list of compiled modules attached to one log source,
+    handed to the reader thread of that source at startup.
+    '''
+    source: Union[str, None]                            # The log source (None => journalctl)
+    modules: tuple[ModuleRules, ...]                    # Modules attached to the source
+    service_matcher: Union[re.Pattern, None]            # The service names merged in one pattern (None if not combinable), journal_match modules excluded
+    service_groups: MappingProxyType                    # {group name in service_matcher: position in modules}
+    prefilter: Union[Prefilter, None]                   # Keywords prefilter (None if one module has no keyword or uses journal_match)
+    journal_modules: tuple[ModuleRules, ...]            # Modules selected by their journal_match fields instead of their service name
+
+def compile_source(source: Union[str, None], modules: list[ModuleRules]) -> SourceRules:
+    """Build the dispatch entry of a log source
+
+    Args:
+        source (str | None): The log source (None => journalctl)
+        modules (list[ModuleRules]): The compiled modules reading this source
+
+    Returns:
+        SourceRules: The dispatch entry of the source
+    """
+    # The modules with journal_match are selected by the fields of the entry (Intercept.run_entry)
+    service_names = {position: rules.service_name.pattern for position, rules in enumerate(modules) if not rules.journal_match}
+    service_matcher, service_groups = combine_patterns(service_names)
+
+    prefilter = None
+    if modules and all(rules.keywords and not rules.journal_match for rules in modules):
+        prefilter = Prefilter([keyword for rules in modules for keyword in rules.keywords])
+
+    return SourceRules(
+        source=source,
+        modules=tuple(modules),
+        service_matcher=service_matcher,
+        service_groups=service_groups,
+        prefilter=prefilter,
+        journal_modules=tuple(rules for rules in modules if rules.journal_match)
+    )
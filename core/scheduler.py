@@ -0,0 +1,83 @@
+import heapq, threading, time
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from core.base import Base
+
+class ReleaseScheduler:
+    '''### Release the jailed ip when their jail duration expire
+    - Min-heap of (expiry unixtime, ip), the thread sleeps until the next expiry
+    - Only the due entries are released, the database is read once at startup (Base.iptables_load_bans)
+    - An ip jailed again keeps its old entry in the heap, Base.ip_tables_release ignores it
+    '''
+
+    def __init__(self, base:'Base') -> None:
+
+        self.Base = base
+        self.heap:list[tuple[float, str]] = []          # [(expiry unixtime, ip)]
+        self.condition = threading.Condition()
+        self.is_running = True
+
+        return None
+
+    def schedule(self, ip:str, expiry:float) -> None:
+        """Release the ip at the expiry
+
+        Args:
+            ip (str): The jailed ip address
+            expiry (float): Unixtime of the release
+        """
+        with self.condition:
+            heapq.heappush(self.heap, (expiry, ip))
+            # Wake up the thread only if the next expiry changed
+            if self.heap[0] == (expiry, ip):
+                self.condition.notify()
+
+        return None
+
+    def pop_due(self, now:float) -> list[str]:
+        """Remove the due entries from the heap
+
+        Args:
+            now (float): Current unixtime
+
+        Returns:
+            list[str]: The ip to release
+        """
+        due:list[str] = []
+
+        with self.condition:
+            while self.heap and self.heap[0][0] <= now:
+                due.append(heapq.heappop(self.heap)[1])
+
+        return due
+
+    def run(self) -> None:
+        """Release the due ip until stop() is called
+        this method must be run in a thread
+        """
+        while self.is_running:
+            with self.condition:
+                if not self.heap:
+                    self.condition.wait()
+                else:
+                    timeout = self.heap[0][0] - time.time()
+                    if timeout > 0:
+                        self.condition.wait(timeout)
+
+            for ip in self.pop_due(time.time()):
+                self.Base.ip_tables_release(ip)
+
+        return None
+
+    def stop(self) -> None:
+
+        with self.condition:
+            self.is_running = False
+            self.condition.notify()
+
+        return None
+
+    def __len__(self) -> int:
+
+        return len(self.heap)
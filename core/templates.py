@@ -0,0 +1,198 @@
+import re, threading, time
+from typing import TYPE_CHECKING, Iterable, Union
+
+if TYPE_CHECKING:
+    from core.base import Base
+
+class IntrusionTemplates:
+    '''### Deduplicated storage of logs.intrusion_detail
+    - A raw line is split into a template (stored once in intrusion_templates) and its variable fields
+    - The variable fields are the numbers (pid, port, ipv4, dates), the ipv6 addresses and the user of the attempt
+    - logs.intrusion_detail keeps the raw line only when there is no template, it is NULL for the templated rows:
+      the raw line is only rebuilt in python by decode (an sql reader of the logs view doesn't get it)
+    - The template ids are allocated in memory, the new templates are written by the DbWriter before the log
+    - The templates no log references anymore are purged by clean_db_logs
+    '''
+
+    VARIABLES = re.compile(r'(?<![\w:])[0-9A-Fa-f]{0,4}(?::[0-9A-Fa-f]{0,4}){2,7}(?![\w:])|\d+(?:\.\d+)*')
+    PLACEHOLDER = '\x1e'                                # Position of a variable in the template
+    SEPARATOR = '\x1f'                                  # Separator of the variables
+    MAX_TEMPLATES = 100000                              # Above, the new lines are stored raw until the next purge
+    PURGE_GRACE = 300                                   # Seconds a template is kept after its last use (logs still queued)
+
+    def __init__(self, base:'Base') -> None:
+
+        self.Base = base
+        self.lock = threading.Lock()
+        self.templates:dict[str, int] = {}              # {template: id}
+        self.ids:dict[int, str] = {}                    # {id: template}
+        self.last_used:dict[int, float] = {}            # {id: unixtime of the last encode}
+
+        query = 'SELECT id, template FROM intrusion_templates'
+        for template_id, template in self.Base.db_execute_query(query).fetchall():
+            self.templates[template] = template_id
+            self.ids[template_id] = template
+
+        self.last_template_id = self.Base.DbWriter.get_last_id('intrusion_templates')
+
+        return None
+
+    def split(self, line:str, literals:Iterable[Union[str, None]] = ()) -> Union[tuple[str, str], None]:
+        """Split a raw line into its template and its variables
+
+        Args:
+            line (str): The raw line
+            literals (Iterable[Union[str, None]], optional): Values cut out as whole words too (the user). Defaults to ().
+
+        Returns:
+            Union[tuple[str, str], None]: (template, variables), None if the line can't be stored as a template
+        """
+        if not line or self.PLACEHOLDER in line or self.SEPARATOR in line:
+            return None
+
+        spans:list[tuple[int, int, int]] = []           # [(start, priority, end)] the literals first on the same start
+
+        for literal in literals:
+            if not literal:
+                continue
+            start = line.find(literal)
+            while start != -1:
+                end = start + len(literal)
+                if not self.is_word_character(line, start - 1) and not self.is_word_character(line, end):
+                    spans.append((start, 0, end))
+                start = line.find(literal, start + 1)
+
+        for lookup in self.VARIABLES.finditer(line):
+            spans.append((lookup.start(), 1, lookup.end()))
+
+        template_parts:list[str] = []
+        variables:list[str] = []
+        position = 0
+
+        for start, priority, end in sorted(spans):
+            # The spans overlapping a previous one are ignored
+            if start < position:
+                continue
+            template_parts.append(line[position:start])
+            variables.append(line[start:end])
+            position = end
+
+        template_parts.append(line[position:])
+
+        return self.PLACEHOLDER.join(template_parts), self.SEPARATOR.join(variables)
+
+    def is_word_character(self, line:str, position:int) -> bool:
+
+        return 0 <= position < len(line) and (line[position].isalnum() or line[position] == '_')
+
+    @classmethod
+    def build(cls, template:Union[str, None], variables:Union[str, None]) -> Union[str, None]:
+        """Rebuild the raw line
+
+        Args:
+            template (Union[str, None]): The template
+            variables (Union[str, None]): The variables
+
+        Returns:
+            Union[str, None]: The raw line, None if there is no template
+        """
+        if template is None:
+            return None
+
+        parts = template.split(cls.PLACEHOLDER)
+        values = variables.split(cls.SEPARATOR) if variables else []
+
+        if len(values) != len(parts) - 1:
+            return None
+
+        line = parts[0]
+        for value, part in zip(values, parts[1:]):
+            line += value + part
+
+        return line
+
+    def decode(self, intrusion_detail:Union[str, None], template_id:Union[int, None], variables:Union[str, None]) -> Union[str, None]:
+        """The raw line of a log row
+
+        Args:
+            intrusion_detail (Union[str, None]): logs.intrusion_detail (the raw line when there is no template)
+            template_id (Union[int, None]): logs.intrusion_template_id
+            variables (Union[str, None]): logs.intrusion_variables
+
+        Returns:
+            Union[str, None]: The raw line
+        """
+        if template_id is None:
+            return intrusion_detail
+
+        return self.build(self.ids.get(template_id), variables)
+
+    def encode(self, line:str, literals:Iterable[Union[str, None]] = ()) -> tuple[Union[int, None], Union[str, None], Union[str, None]]:
+        """The values to store in the logs table for a raw line
+        a new template is queued in the DbWriter (before the log that uses it)
+
+        Args:
+            line (str): The raw line
+            literals (Iterable[Union[str, None]], optional): Values cut out as whole words too (the user). Defaults to ().
+
+        Returns:
+            tuple: (template id, variables, raw line), the raw line is only returned when there is no template
+        """
+        splitted = self.split(line, literals)
+        if splitted is None:
+            return None, None, line
+
+        template, variables = splitted
+
+        with self.lock:
+            template_id = self.templates.get(template)
+
+            if template_id is None:
+                if len(self.templates) >= self.MAX_TEMPLATES:
+                    return None, None, line
+
+                self.last_template_id += 1
+                template_id = self.last_template_id
+                self.templates[template] = template_id
+                self.ids[template_id] = template
+
+                query = 'INSERT INTO intrusion_templates (id, template) VALUES (:id, :template)'
+                self.Base.DbWriter.write(query, {'id': template_id, 'template': template})
+
+            self.last_used[template_id] = time.time()
+
+        return template_id, variables, None
+
+    def purge(self) -> int:
+        """Remove the templates no log references anymore (not used for PURGE_GRACE seconds)
+
+        Returns:
+            int: The number of templates removed
+        """
+        query_unused = '''SELECT id FROM intrusion_templates t
+                    WHERE NOT EXISTS (SELECT 1 FROM logs l WHERE l.intrusion_template_id = t.id)
+                '''
+        unused_ids = [template_id for template_id, in self.Base.db_execute_query(query_unused).fetchall()]
+        removed = 0
+
+        # 500 ids by statement, below the sqlite limit of variables
+        for position in range(0, len(unused_ids), 500):
+            with self.lock:
+                # Used since the select: a log referencing it may still be queued in the DbWriter
+                limit = time.time() - self.PURGE_GRACE
+                template_ids = [template_id for template_id in unused_ids[position:position + 500] if self.last_used.get(template_id, 0) < limit]
+                if not template_ids:
+                    continue
+
+                # Deleted before the lock is released: the same template can be queued again with a new id
+                my_data = {f'id{i}': template_id for i, template_id in enumerate(template_ids)}
+                query_delete = f"DELETE FROM intrusion_templates WHERE id IN ({', '.join(f':id{i}' for i in range(len(template_ids)))})"
+                self.Base.db_execute_query(query_delete, my_data)
+
+                for template_id in template_ids:
+                    self.templates.pop(self.ids.pop(template_id, None), None)
+                    self.last_used.pop(template_id, None)
+
+                removed += len(template_ids)
+
+        return removed
@@ -0,0 +1,81 @@
+import ipaddress
+from bisect import bisect_right
+from typing import Iterable, Union
+
+class IpWhitelist:
+    '''### Ip addresses and CIDR ranges exempted from the analysis
+    - Parsed once: "192.168.1.11", "10.0.0.0/8", "2001:db8::/32"
+    - Every family is stored as sorted and merged intervals, the lookup is a bisect (O(log n))
+    - IPv4-mapped IPv6 addresses (::ffff:1.2.3.4) are checked as IPv4
+    '''
+
+    def __init__(self, entries:Iterable[str] = ()) -> None:
+
+        self.entries:list[str] = []                                 # The valid entries as written in the configuration
+        self.invalid:list[str] = []                                 # The entries that are not an ip address or a network
+        self.starts:dict[int, list[int]] = {4: [], 6: []}           # {ip version: [first address of every interval]}
+        self.ends:dict[int, list[int]] = {4: [], 6: []}             # {ip version: [last address of every interval]}
+
+        intervals:dict[int, list[tuple[int, int]]] = {4: [], 6: []}
+
+        for entry in entries:
+            try:
+                network = ipaddress.ip_network(str(entry).strip(), strict=False)
+            except ValueError:
+                self.invalid.append(entry)
+                continue
+
+            self.entries.append(entry)
+            intervals[network.version].append((int(network.network_address), int(network.broadcast_address)))
+
+        for version, version_intervals in intervals.items():
+            for start, end in sorted(version_intervals):
+                # Overlapping or adjacent: extend the previous interval
+                if self.ends[version] and start <= self.ends[version][-1] + 1:
+                    self.ends[version][-1] = max(self.ends[version][-1], end)
+                else:
+                    self.starts[version].append(start)
+                    self.ends[version].append(end)
+
+        return None
+
+    def __contains__(self, ip:Union[str, None]) -> bool:
+
+        if not ip:
+            return False
+
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return False
+
+        if address.version == 6 and not address.ipv4_mapped is None:
+            address = address.ipv4_mapped
+
+        starts = self.starts[address.version]
+        position = bisect_right(starts, int(address)) - 1
+
+        return position >= 0 and int(address) <= self.ends[address.version][position]
+
+    def overlaps(self, network:str) -> bool:
+        """Check if a network contains at least one whitelisted address
+
+        Args:
+            network (str): The network in CIDR notation
+
+        Returns:
+            bool: True if the network and the whitelist overlap
+        """
+        try:
+            network = ipaddress.ip_network(network, strict=False)
+        except ValueError:
+            return False
+
+        first, last = int(network.network_address), int(network.broadcast_address)
+        position = bisect_right(self.starts[network.version], last) - 1
+
+        return position >= 0 and self.ends[network.version][position] >= first
+
+    def __len__(self) -> int:
+
+        return len(self.starts[4]) + len(self.starts[6])
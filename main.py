@@ -29,7 +29,18 @@ def main():
             BaseInstance.logs.debug(f'Terminate subprocess {subprocess}')
             subprocess.terminate()
 
-        BaseInstance.ip_tables_reset()
+        if not IProcInstance.journal is None:
+            IProcInstance.journal.stop()
+
+        if not IProcInstance.follower is None:
+            IProcInstance.follower.stop()
+
+        if BaseInstance.keep_bans_on_shutdown:
+            BaseInstance.ip_tables_stop()
+        else:
+            BaseInstance.ip_tables_reset()
+
+        BaseInstance.DbWriter.stop()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
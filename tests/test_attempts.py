@@ -0,0 +1,53 @@
+import unittest
+
+from core.attempts import AttemptTracker
+
+class TestAttemptTracker(unittest.TestCase):
+
+    def test_out_of_order_timestamps(self):
+
+        tracker = AttemptTracker()
+        now = 100000
+
+        # Interleaved sources: the events don't arrive sorted by time
+        self.assertEqual(tracker.add('sshd', '1.2.3.4', '1', now - 10, 600, now), 1)
+        self.assertEqual(tracker.add('sshd', '1.2.3.4', '2', now - 500, 600, now), 2)
+        self.assertEqual(tracker.add('sshd', '1.2.3.4', '3', now - 590, 600, now), 3)
+
+        # now - 590 and now - 500 are out of the window, now - 10 is behind them in the dict
+        self.assertEqual(tracker.add('sshd', '1.2.3.4', '4', now + 101, 600, now + 101), 2)
+        self.assertEqual(set(tracker.attempts[('sshd', '1.2.3.4')]), {'1', '4'})
+
+    def test_replayed_attempt_out_of_window(self):
+
+        tracker = AttemptTracker()
+        now = 100000
+
+        self.assertEqual(tracker.add('sshd', '1.2.3.4', '1', now - 700, 600, now), 0)
+        self.assertEqual(tracker.purge(now), 1)
+
+    def test_older_duplicate_keeps_the_last_timestamp(self):
+
+        tracker = AttemptTracker()
+        now = 100000
+
+        tracker.add('sshd', '1.2.3.4', '1', now - 10, 600, now)
+        tracker.add('sshd', '1.2.3.4', '1', now - 500, 600, now)
+
+        self.assertEqual(tracker.attempts[('sshd', '1.2.3.4')]['1'], now - 10)
+        self.assertEqual(tracker.purge(now + 200), 0)
+
+    def test_purge(self):
+
+        tracker = AttemptTracker()
+        now = 100000
+
+        tracker.add('sshd', '1.2.3.4', '1', now - 10, 600, now)
+        tracker.add('sshd', '1.2.3.4', '2', now - 590, 600, now)
+        tracker.add('sshd', '5.6.7.8', '1', now - 590, 600, now)
+
+        self.assertEqual(tracker.purge(now + 100), 1)
+        self.assertEqual(set(tracker.attempts[('sshd', '1.2.3.4')]), {'1'})
+
+if __name__ == '__main__':
+    unittest.main()